@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : chat_history_benchmark.py
+聊天记录库写入吞吐基准：对比默认 engine 与 create_chat_engine 的 WAL 配置，
+在 1 / 8 / 32 个并发会话下分别测量逐条提交（旧 save_message 写法）和 MessageWriter 批量写入的 messages/sec。
+
+运行：python -m lchain.chat_history_benchmark
+"""
+import os
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import sessionmaker
+
+from lchain.langchain_rag_with_SQLAlchemy import Base, Message, MessageWriter, Session, create_chat_engine
+
+CONCURRENCY_LEVELS = (1, 8, 32)
+MESSAGES_PER_SESSION = 200
+CONTENT = "What is Task Decomposition? " * 8
+
+
+def make_engine(profile, path):
+    url = f"sqlite:///{path}"
+    if profile == "default":
+        return create_engine(url)
+    return create_chat_engine(url, pool_size=32, max_overflow=32)
+
+
+def write_direct(session_factory, session_id, errors):
+    """
+    每条消息一个事务，与改造前的 save_message 相同。
+    """
+    db = session_factory()
+    try:
+        session = Session(session_id=session_id)
+        db.add(session)
+        db.commit()
+        for seq in range(MESSAGES_PER_SESSION):
+            try:
+                db.execute(insert(Message), [{"session_id": session.id, "role": "human", "content": CONTENT, "seq": seq}])
+                db.commit()
+            except SQLAlchemyError:
+                db.rollback()
+                errors.append(session_id)
+    finally:
+        db.close()
+
+
+def write_behind(writer, session_id, errors):
+    for seq in range(MESSAGES_PER_SESSION):
+        writer.enqueue(session_id, "human", CONTENT, seq)
+
+
+def run(profile, mode, concurrency):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = make_engine(profile, os.path.join(tmp_dir, "bench.db"))
+        Base.metadata.create_all(engine)
+        session_factory = sessionmaker(bind=engine)
+        writer = MessageWriter(session_factory) if mode == "writer" else None
+        errors = []
+
+        start = time.perf_counter()
+        threads = [
+            threading.Thread(
+                target=write_behind if writer else write_direct,
+                args=(writer or session_factory, f"bench-{i}", errors),
+            )
+            for i in range(concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if writer:
+            writer.close()
+        elapsed = time.perf_counter() - start
+        engine.dispose()
+
+    total = concurrency * MESSAGES_PER_SESSION
+    return {"profile": profile, "mode": mode, "sessions": concurrency,
+            "messages_per_sec": round(total / elapsed), "errors": len(errors)}
+
+
+if __name__ == '__main__':
+    print(f"{'profile':<8} {'mode':<7} {'sessions':>8} {'msg/s':>10} {'errors':>7}")
+    for profile in ("default", "wal"):
+        for mode in ("direct", "writer"):
+            for concurrency in CONCURRENCY_LEVELS:
+                r = run(profile, mode, concurrency)
+                print(f"{r['profile']:<8} {r['mode']:<7} {r['sessions']:>8} {r['messages_per_sec']:>10} {r['errors']:>7}")
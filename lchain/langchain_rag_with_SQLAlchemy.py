@@ -5,7 +5,16 @@
 使用 SQLAlchemy 在 SQLite 数据库中保存聊天历史记录，需要进行一些关键的添加和修改。以下是这些更改的分步说明：
 """
 
+import asyncio
 import os
+import queue
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 
 # Step 1. 首先，导入必要的 SQLAlchemy 模块来设置数据库和 ORM（对象关系映射）。这些模块将允许以 Python 方式与 SQLite 数据库进行交互。
 import bs4
@@ -13,21 +22,34 @@ from dashscope import TextEmbedding
 from dotenv import load_dotenv
 from langchain_chroma import Chroma
 from langchain_classic.chains.combine_documents import create_stuff_documents_chain
-from langchain_classic.chains.history_aware_retriever import create_history_aware_retriever
-from langchain_classic.chains.retrieval import create_retrieval_chain
 from langchain_community.chat_message_histories import ChatMessageHistory
 from langchain_community.chat_models import ChatZhipuAI, ChatTongyi
-from langchain_community.document_loaders import WebBaseLoader
 from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnablePassthrough
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey
-from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey
+from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey, UniqueConstraint, Index, event, select
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import sessionmaker, relationship, declarative_base
 from sqlalchemy.orm import sessionmaker, relationship, declarative_base
+from sqlalchemy.pool import QueuePool
+
+from utils.context_packing import pack_context
+from utils.embedding_batcher import QueryBatcher
+from utils.embedding_cache import CachedEmbeddings
+from utils.history_aware import create_standalone_question_chain, rewrite_stats
+from utils.hybrid_retriever import HybridRetriever
+from utils.incremental_index import IncrementalIndexer
+from utils.ingest_pipeline import IngestPipeline, chroma_upsert
+from utils.semantic_cache import SemanticAnswerCache, create_cached_retrieval_chain
+from utils.tokens import estimate_tokens
+from utils.web_loader import CachedWebLoader
 
 key = os.getenv("DASHSCOPE_API_KEY")
 # 在控制台先安装 pip install --upgrade  langchain langchain-community langchainhub httpx httpx-sse PyJWT langchain-chroma bs4 python-dotenv sqlalchemy
@@ -54,13 +76,84 @@ class Message(Base):
     Message 类表示会话中的各个消息
     """
     __tablename__ = "messages"
+    # 同一会话内 seq 唯一，重复写入同一条消息会被忽略，保证持久化幂等；
+    # (session_id, id) 复合索引用于按会话倒序分页加载最近的消息
+    __table_args__ = (
+        UniqueConstraint("session_id", "seq"),
+        Index("ix_messages_session_id_id", "session_id", "id"),
+    )
     id = Column(Integer, primary_key=True)
     session_id = Column(Integer, ForeignKey("sessions.id"), nullable=False)
+    # 消息在会话中的序号，从 0 开始
+    seq = Column(Integer, nullable=False)
     role = Column(String, nullable=False)
     content = Column(Text, nullable=False)
     session = relationship("Session", back_populates="messages")
 
 
+def register_sqlite_pragmas(engine, busy_timeout_ms=5000, cache_size_kb=64 * 1024):
+    """
+    每个新连接建立时设置的 PRAGMA，同步和异步 engine 共用（异步 engine 传入 engine.sync_engine）。
+    """
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+        # 负数表示以 KB 为单位
+        cursor.execute(f"PRAGMA cache_size=-{int(cache_size_kb)}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
+def create_chat_engine(database_url="sqlite:///chat_history.db", pool_size=8, max_overflow=16,
+                       busy_timeout_ms=5000, cache_size_kb=64 * 1024):
+    """
+    创建聊天记录数据库的 engine：每个连接建立时打开 WAL 日志、synchronous=NORMAL、busy_timeout 和更大的页缓存，
+    读写互不阻塞，并发写入时等待锁而不是直接报 database is locked；连接池允许多个线程各自持有连接。
+    """
+    engine = create_engine(
+        database_url,
+        poolclass=QueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        connect_args={"check_same_thread": False, "timeout": busy_timeout_ms / 1000},
+    )
+
+    register_sqlite_pragmas(engine, busy_timeout_ms, cache_size_kb)
+    return engine
+
+
+def migrate_chat_schema(engine):
+    """
+    create_all 不会修改已经存在的表：旧版数据库的 messages 表没有 seq 列。这里补上 seq 列，
+    按 id 顺序为每个会话回填 0, 1, 2, ...，再建立 (session_id, seq) 唯一索引和分页用的复合索引。
+    已经是新结构的数据库上什么都不做。
+    """
+    with engine.begin() as conn:
+        columns = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(messages)")}
+        if not columns or "seq" in columns:
+            return
+        conn.exec_driver_sql("ALTER TABLE messages ADD COLUMN seq INTEGER")
+        # 先把每条消息的序号算到临时表里，UPDATE 时按主键查找，避免逐行做相关子查询
+        conn.exec_driver_sql(
+            "CREATE TEMP TABLE message_seq AS SELECT id, "
+            "ROW_NUMBER() OVER (PARTITION BY session_id ORDER BY id) - 1 AS seq FROM messages"
+        )
+        conn.exec_driver_sql("CREATE UNIQUE INDEX temp.ix_message_seq_id ON message_seq (id)")
+        conn.exec_driver_sql(
+            "UPDATE messages SET seq = (SELECT seq FROM message_seq WHERE message_seq.id = messages.id)"
+        )
+        conn.exec_driver_sql("DROP TABLE message_seq")
+        conn.exec_driver_sql(
+            "CREATE UNIQUE INDEX IF NOT EXISTS uq_messages_session_id_seq ON messages (session_id, seq)"
+        )
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_messages_session_id_id ON messages (session_id, id)")
+
+
 def get_db():
     """
     创建一个实用程序函数来管理数据库会话。该函数将确保每个数据库会话正确打开和关闭。
@@ -72,134 +165,645 @@ def get_db():
         db.close()
 
 
-def save_message(session_id: str, role: str, content: str):
+class MessageWriter:
     """
-    定义一个函数将各个消息保存到数据库中。该函数检查会话是否存在；如果没有，它就会创建一个。然后它将消息保存到相应的会话中。
+    后台批量写入消息（write-behind）。调用方只把消息放进队列立即返回，后台线程攒够 max_batch 条
+    或等待 flush_interval 秒后，在一个事务里批量插入；session_id -> 主键的映射缓存在内存中，
+    避免每条消息都查询一次 sessions 表。
+    写入失败的批次等待 retry_interval 秒后放回队列重试（按 seq 幂等插入，重试不会产生重复），
+    等待中的 flush 会一直等到它真正写入；只有关闭时重试 max_retries 次仍失败才放弃。
     """
-    db = next(get_db())
-    try:
-        # Check if the session already exists
-        session = db.query(Session).filter(Session.session_id == session_id).first()
-        if not session:
-            # Create a new session if it doesn't exist
-            session = Session(session_id=session_id)
-            db.add(session)
+
+    def __init__(self, session_factory, max_batch=200, flush_interval=0.2, retry_interval=1.0, max_retries=3):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.max_retries = max_retries
+        self._queue = queue.Queue()
+        self._session_pks = {}
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+        self._thread.start()
+
+    def enqueue(self, session_id: str, role: str, content: str, seq: int):
+        self.enqueue_many([(session_id, role, content, seq)])
+
+    def enqueue_many(self, rows):
+        """
+        一次入队多条 (session_id, role, content, seq)，它们会在同一个事务中写入。
+        """
+        if self._closed:
+            raise RuntimeError("MessageWriter is closed")
+        if rows:
+            self._queue.put(list(rows))
+
+    def flush(self, timeout=None):
+        """
+        阻塞直到此前入队的消息全部写入数据库。
+        """
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            batch, waiters, stop = [], [], False
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is None:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    # flush 请求：不再等待，立即写出当前批次
+                    waiters.append(item)
+                    break
+                else:
+                    batch.extend(item)
+                if stop or len(batch) >= self.max_batch:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if batch and not self._write(batch):
+                if not stop:
+                    # 整批连同在它之后的 flush 请求放回队列，稍后与新消息一起重试
+                    time.sleep(self.retry_interval)
+                    self._queue.put(batch)
+                    for waiter in waiters:
+                        self._queue.put(waiter)
+                    continue
+                for _ in range(self.max_retries):
+                    time.sleep(self.retry_interval)
+                    if self._write(batch):
+                        break
+                else:
+                    print(f"Gave up persisting {len(batch)} messages on shutdown")
+            for waiter in waiters:
+                waiter.set()
+            if stop:
+                return
+
+    def _resolve_session_pks(self, db, session_ids):
+        unknown = [sid for sid in set(session_ids) if sid not in self._session_pks]
+        if not unknown:
+            return
+        for pk, sid in db.query(Session.id, Session.session_id).filter(Session.session_id.in_(unknown)):
+            self._session_pks[sid] = pk
+        missing = [sid for sid in unknown if sid not in self._session_pks]
+        if missing:
+            new_sessions = [Session(session_id=sid) for sid in missing]
+            db.add_all(new_sessions)
+            db.flush()
+            for session in new_sessions:
+                self._session_pks[session.session_id] = session.id
+
+    def _write(self, batch):
+        """
+        在一个事务中写入整批消息，返回是否成功。
+        """
+        db = self.session_factory()
+        try:
+            self._resolve_session_pks(db, [sid for sid, _, _, _ in batch])
+            db.execute(
+                insert(Message).on_conflict_do_nothing(index_elements=["session_id", "seq"]),
+                [{"session_id": self._session_pks[sid], "role": role, "content": content, "seq": seq}
+                 for sid, role, content, seq in batch],
+            )
             db.commit()
-            db.refresh(session)
+            return True
+        except SQLAlchemyError as e:
+            db.rollback()
+            # 回滚后新建的 session 主键可能无效，清空映射缓存，下次重新查询
+            self._session_pks.clear()
+            print(f"Failed to persist {len(batch)} messages, will retry: {e}")
+            return False
+        finally:
+            db.close()
 
-        # Add the message to the session
-        db.add(Message(session_id=session.id, role=role, content=content))
-        db.commit()
-    except SQLAlchemyError:
-        db.rollback()
-    finally:
-        db.close()
+
+# 每个会话的持久化水位：base 为内存历史第 0 条消息对应的 seq，stored 为内存历史中已持久化（或已入队）的条数
+sync_marks = {}
 
 
-def load_session_history(session_id: str) -> BaseChatMessageHistory:
+def save_message(session_id: str, role: str, content: str):
     """
-    定义一个函数来从数据库加载聊天历史记录。此函数检索与给定会话 ID 关联的所有消息并重建聊天历史记录。
+    定义一个函数将各个消息保存到数据库中。消息交给 MessageWriter 在后台批量写入，调用方不需要等待磁盘提交；
+    会话不存在时由 MessageWriter 负责创建。消息占用会话的下一个 seq，并推进水位。
     """
-    db = next(get_db())
+    mark = sync_marks.setdefault(session_id, {"base": 0, "stored": 0})
+    message_writer.enqueue(session_id, role, content, mark["base"] + mark["stored"])
+    mark["stored"] += 1
+
+
+def message_role(message):
+    """
+    返回内存消息对应的 role，不支持的消息返回 None。
+    """
+    if isinstance(message, dict):
+        return message.get("role") if "content" in message else None
+    if isinstance(message, HumanMessage):
+        return "human"
+    if isinstance(message, AIMessage):
+        return "ai"
+    return None
+
+
+def flush_session(session_id: str, chat_history: BaseChatMessageHistory):
+    """
+    只把水位之后、尚未持久化的消息交给 MessageWriter，全部在一个事务中写入。
+    """
+    mark = sync_marks.setdefault(session_id, {"base": 0, "stored": 0})
+    messages = chat_history.messages
+    rows = []
+    for i in range(mark["stored"], len(messages)):
+        message = messages[i]
+        role = message_role(message)
+        if role is None:
+            print(f"Skipped an unsupported message: {message}")
+            continue
+        content = message["content"] if isinstance(message, dict) else message.content
+        rows.append((session_id, role, content, mark["base"] + i))
+    # save_message 可能先于链把消息加入内存历史，水位只前进不后退
+    mark["stored"] = max(mark["stored"], len(messages))
+    return rows
+
+
+# 加载历史时的窗口：最多保留最近的多少条消息 / 多少 token，None 表示不限制
+HISTORY_MAX_MESSAGES = 50
+HISTORY_MAX_TOKENS = 4000
+
+MESSAGE_TYPES = {"human": HumanMessage, "ai": AIMessage, "system": SystemMessage}
+
+
+def history_page_query(session_id: str, cursor, limit):
+    """
+    keyset 分页：取 id 小于 cursor 的最近 limit 条消息，命中 (session_id, id) 复合索引。
+    """
+    stmt = (
+        select(Message.id, Message.seq, Message.role, Message.content)
+        .join(Session, Session.id == Message.session_id)
+        .where(Session.session_id == session_id)
+    )
+    if cursor is not None:
+        stmt = stmt.where(Message.id < cursor)
+    return stmt.order_by(Message.id.desc()).limit(limit)
+
+
+def collect_history_page(rows, page, tokens, limit, max_messages, max_tokens):
+    """
+    把一页（按 id 倒序）加入窗口，返回 (累计 token 数, 是否已取满窗口)。
+    """
+    for row in page:
+        tokens += estimate_tokens(row.content)
+        if rows and max_tokens is not None and tokens > max_tokens:
+            return tokens, True
+        rows.append(row)
+    return tokens, len(page) < limit or (max_messages is not None and len(rows) >= max_messages)
+
+
+def build_chat_history(session_id: str, rows) -> BaseChatMessageHistory:
+    """
+    一次性把（按 id 倒序的）行转换成消息对象并批量加入历史，同时初始化该会话的水位。
+    """
+    rows = rows[::-1]
     chat_history = ChatMessageHistory()
+    chat_history.add_messages([
+        MESSAGE_TYPES.get(row.role, HumanMessage)(content=row.content) for row in rows
+    ])
+    if rows:
+        # 已加载的消息都已在库中，水位从最后一条之后开始
+        sync_marks[session_id] = {"base": rows[0].seq, "stored": len(rows)}
+    return chat_history
+
+
+def load_session_history(session_id: str, max_messages=HISTORY_MAX_MESSAGES, max_tokens=HISTORY_MAX_TOKENS,
+                         page_size=100) -> BaseChatMessageHistory:
+    """
+    定义一个函数来从数据库加载聊天历史记录。只加载最近的窗口（最后 max_messages 条 / max_tokens 个 token），
+    借助 (session_id, id) 复合索引按 id 倒序做 keyset 分页，加载耗时不随历史总长度增长。
+    """
+    db = next(get_db())
+    rows = []
     try:
-        # Retrieve the session
-        session = db.query(Session).filter(Session.session_id == session_id).first()
-        if session:
-            # Add each message to the chat history
-            for message in session.messages:
-                chat_history.add_message({"role": message.role, "content": message.content})
-    except SQLAlchemyError:
-        pass
+        tokens, cursor, done = 0, None, False
+        while not done:
+            limit = page_size if max_messages is None else min(page_size, max_messages - len(rows))
+            page = db.execute(history_page_query(session_id, cursor, limit)).all()
+            tokens, done = collect_history_page(rows, page, tokens, limit, max_messages, max_tokens)
+            if page:
+                cursor = page[-1].id
     finally:
+        # 加载失败时直接抛出：不能把空历史放进缓存，否则水位从 0 开始，新消息的 seq 与库中已有的冲突而被忽略
         db.close()
 
-    return chat_history
+    return build_chat_history(session_id, rows)
+
+
+class SessionCache:
+    """
+    有界的会话历史缓存：按条数和近似字节数做 LRU 淘汰，并淘汰空闲超过 ttl 秒的会话。
+    被淘汰的会话先交给 on_evict 持久化，下次访问时再从 SQLite 重新加载。
+    正在进行中的轮次用 pinned() 固定会话，固定期间不会被淘汰（否则水位被清除，AI 回复会拿到重复的 seq）。
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=None, ttl=None, on_evict=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # session_id -> [chat_history, last_access, approx_bytes]
+        self._bytes = 0
+        self._pins = {}  # session_id -> 进行中的轮次数
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def pinned(self, session_id):
+        with self._lock:
+            self._pins[session_id] = self._pins.get(session_id, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pins[session_id] -= 1
+                if not self._pins[session_id]:
+                    del self._pins[session_id]
+                self._shrink()
+
+    @staticmethod
+    def _approx_bytes(chat_history):
+        # 每条消息按内容长度加上固定的对象开销估算
+        return sum(sys.getsizeof(getattr(m, "content", "")) + 200 for m in chat_history.messages)
+
+    def get(self, session_id):
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(session_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(session_id)
+            entry[1] = time.monotonic()
+            # 历史在缓存期间会增长，访问时刷新大小
+            size = self._approx_bytes(entry[0])
+            self._bytes += size - entry[2]
+            entry[2] = size
+            self._shrink()
+            return entry[0]
+
+    def put(self, session_id, chat_history):
+        with self._lock:
+            old = self._entries.pop(session_id, None)
+            if old is not None:
+                self._bytes -= old[2]
+            size = self._approx_bytes(chat_history)
+            self._entries[session_id] = [chat_history, time.monotonic(), size]
+            self._bytes += size
+            self._expire()
+            self._shrink()
+
+    def items(self):
+        with self._lock:
+            return [(session_id, entry[0]) for session_id, entry in self._entries.items()]
+
+    def __contains__(self, session_id):
+        return session_id in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": len(self._entries), "approx_bytes": self._bytes}
+
+    def _evict(self, session_id):
+        entry = self._entries.pop(session_id)
+        self._bytes -= entry[2]
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(session_id, entry[0])
+
+    def _oldest_unpinned(self):
+        return next((session_id for session_id in self._entries if session_id not in self._pins), None)
+
+    def _expire(self):
+        if self.ttl is None:
+            return
+        deadline = time.monotonic() - self.ttl
+        expired = [session_id for session_id, entry in self._entries.items()
+                   if entry[1] < deadline and session_id not in self._pins]
+        for session_id in expired:
+            self._evict(session_id)
+
+    def _shrink(self):
+        # 最近访问的一条永远保留，即使它单独超过了 max_bytes；固定中的会话跳过
+        while len(self._entries) > 1 and (
+                len(self._entries) > self.max_entries
+                or (self.max_bytes is not None and self._bytes > self.max_bytes)):
+            session_id = self._oldest_unpinned()
+            if session_id is None or session_id == next(reversed(self._entries)):
+                break
+            self._evict(session_id)
+
+
+def persist_evicted_session(session_id: str, chat_history: BaseChatMessageHistory):
+    """
+    会话被淘汰前把未持久化的消息交给 MessageWriter，并清除水位，重新加载时以数据库为准。
+    进行中的轮次通过 store.pinned() 固定了会话，不会走到这里，因此清除水位是安全的。
+    """
+    message_writer.enqueue_many(flush_session(session_id, chat_history))
+    sync_marks.pop(session_id, None)
 
 
 def get_session_history(session_id: str) -> BaseChatMessageHistory:
     """
     更新 get_session_history 函数以从数据库检索会话历史记录，而不是仅使用内存存储。
+    缓存未命中（首次访问或已被淘汰）时从 SQLite 加载。
     """
-    if session_id not in store:
-        store[session_id] = load_session_history(session_id)
-    return store[session_id]
+    chat_history = store.get(session_id)
+    if chat_history is None:
+        # 等待排队中的写入落盘，避免重新加载时丢掉刚淘汰的消息
+        message_writer.flush()
+        chat_history = load_session_history(session_id)
+        store.put(session_id, chat_history)
+    return chat_history
 
 
 def save_all_sessions():
     """
-    添加退出应用程序之前保存所有会话的功能。此函数迭代内存中的所有会话并将其消息保存到数据库中。
-    增加错误处理以确保程序稳定性。
+    退出应用程序之前保存所有会话：按水位只收集尚未持久化的消息，合并为一次批量写入，
+    耗时只与未保存的消息数有关，与历史长度无关。
     """
-    from langchain_core.messages import HumanMessage
-    from langchain_core.messages import AIMessage
-
+    rows = []
     for session_id, chat_history in store.items():
-        for message in chat_history.messages:
-            # 检查 message 是否为字典类型
-            if isinstance(message, dict):
-                # 检查字典是否包含必要的键
-                if "role" in message and "content" in message:
-                    save_message(session_id, message["role"], message["content"])
-                else:
-                    print(f"Skipped a message due to missing keys: {message}")
-            # 处理 HumanMessage 和 AIMessage 类型的消息
-            elif isinstance(message, HumanMessage):
-                save_message(session_id, "human", message.content)
-            elif isinstance(message, AIMessage):
-                save_message(session_id, "ai", message.content)
-            else:
-                print(f"Skipped an unsupported message type: {message}")
+        rows.extend(flush_session(session_id, chat_history))
+    message_writer.enqueue_many(rows)
 
 
 def invoke_and_save(session_id, input_text):
     """
     修改链式调用函数，同时保存用户问题和AI答案。这确保了每次交互都被记录下来。
     """
-    # Save the user question with role "human"
-    save_message(session_id, "human", input_text)
+    # 整轮期间固定会话，避免在两次 save_message 之间被淘汰
+    with store.pinned(session_id):
+        # 先加载会话历史，确保水位已初始化，问题才能拿到正确的 seq
+        get_session_history(session_id)
+
+        # Save the user question with role "human"
+        save_message(session_id, "human", input_text)
+
+        # Get the AI response
+        result = conversational_rag_chain.invoke(
+            {"input": input_text},
+            config={"configurable": {"session_id": session_id}}
+        )["answer"]
+
+        print(f"invoke_and_save:{result}")
+
+        # Save the AI answer with role "ai"
+        save_message(session_id, "ai", result)
+
+    return result
+
+
+def create_async_chat_engine(database_url="sqlite+aiosqlite:///chat_history.db", busy_timeout_ms=5000,
+                             cache_size_kb=64 * 1024):
+    """
+    异步版本的聊天记录 engine（aiosqlite），连接参数与 create_chat_engine 相同。
+    需要 pip install "sqlalchemy[asyncio]" aiosqlite。
+    """
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    engine = create_async_engine(database_url, connect_args={"timeout": busy_timeout_ms / 1000})
+
+    register_sqlite_pragmas(engine.sync_engine, busy_timeout_ms, cache_size_kb)
+    return engine
+
+
+# 每个会话一把 asyncio 锁，保证同一会话的轮次按顺序执行；不再使用的锁会被自动回收
+session_locks = weakref.WeakValueDictionary()
+# 异步写入路径的 session_id -> 主键缓存
+async_session_pks = {}
+
+
+def session_lock(session_id: str) -> asyncio.Lock:
+    lock = session_locks.get(session_id)
+    if lock is None:
+        lock = session_locks[session_id] = asyncio.Lock()
+    return lock
+
+
+@asynccontextmanager
+async def pinned_session(session_id: str):
+    with store.pinned(session_id):
+        yield
+
+
+async def aload_session_history(session_id: str, max_messages=HISTORY_MAX_MESSAGES,
+                                max_tokens=HISTORY_MAX_TOKENS, page_size=100) -> BaseChatMessageHistory:
+    """
+    load_session_history 的异步版本，查询通过 AsyncSessionLocal 执行，不阻塞事件循环。
+    """
+    rows = []
+    # 与同步版本相同，加载失败时直接抛出，不缓存空历史
+    async with AsyncSessionLocal() as db:
+        tokens, cursor, done = 0, None, False
+        while not done:
+            limit = page_size if max_messages is None else min(page_size, max_messages - len(rows))
+            page = (await db.execute(history_page_query(session_id, cursor, limit))).all()
+            tokens, done = collect_history_page(rows, page, tokens, limit, max_messages, max_tokens)
+            if page:
+                cursor = page[-1].id
+    return build_chat_history(session_id, rows)
+
+
+async def aget_session_history(session_id: str) -> BaseChatMessageHistory:
+    chat_history = store.get(session_id)
+    if chat_history is None:
+        # 等待后台线程中排队的写入落盘后再加载
+        await asyncio.to_thread(message_writer.flush)
+        chat_history = await aload_session_history(session_id)
+        store.put(session_id, chat_history)
+    return chat_history
 
-    # Get the AI response
-    result = conversational_rag_chain.invoke(
-        {"input": input_text},
-        config={"configurable": {"session_id": session_id}}
-    )["answer"]
 
-    print(f"invoke_and_save:{result}")
+async def asave_message(session_id: str, role: str, content: str):
+    """
+    save_message 的异步版本：占用会话的下一个 seq，在一个事务中（必要时先创建会话）写入消息。
+    """
+    mark = sync_marks.setdefault(session_id, {"base": 0, "stored": 0})
+    seq = mark["base"] + mark["stored"]
+    mark["stored"] += 1
+    async with AsyncSessionLocal() as db:
+        try:
+            pk = async_session_pks.get(session_id)
+            if pk is None:
+                await db.execute(
+                    insert(Session).values(session_id=session_id).on_conflict_do_nothing(index_elements=["session_id"])
+                )
+                pk = await db.scalar(select(Session.id).where(Session.session_id == session_id))
+            await db.execute(
+                insert(Message).on_conflict_do_nothing(index_elements=["session_id", "seq"]),
+                [{"session_id": pk, "role": role, "content": content, "seq": seq}],
+            )
+            await db.commit()
+            async_session_pks[session_id] = pk
+        except SQLAlchemyError as e:
+            await db.rollback()
+            # 不丢弃消息：交给 MessageWriter，由它在后台重试直到写入
+            print(f"Failed to persist message for session {session_id}, handing it to the writer: {e}")
+            message_writer.enqueue(session_id, role, content, seq)
 
-    # Save the AI answer with role "ai"
-    save_message(session_id, "ai", result)
+
+async def ainvoke_and_save(session_id, input_text):
+    """
+    invoke_and_save 的异步版本：数据库读写和模型调用都不阻塞事件循环，一个事件循环可以同时服务大量会话；
+    同一会话的轮次由 session_lock 串行化，保证消息顺序。
+    """
+    # 等待 LLM 期间其他会话会 put 进缓存，固定本会话避免被淘汰
+    async with session_lock(session_id), pinned_session(session_id):
+        # 预先加载历史，RunnableWithMessageHistory 随后调用 get_session_history 时直接命中缓存
+        await aget_session_history(session_id)
+
+        await asave_message(session_id, "human", input_text)
+
+        result = (await conversational_rag_chain.ainvoke(
+            {"input": input_text},
+            config={"configurable": {"session_id": session_id}}
+        ))["answer"]
+
+        await asave_message(session_id, "ai", result)
 
     return result
 
 
+# 最近若干轮流式调用的延迟指标：首 token 延迟（ttft）与总耗时，单位秒
+turn_metrics = deque(maxlen=1000)
+
+
+async def astream_and_save(session_id, input_text):
+    """
+    流式版本：答案 token 一到达就 yield 给调用方。AI 消息只在流结束（或被取消/中断）后写入数据库一次，
+    并记录本轮的首 token 延迟和总耗时到 turn_metrics。
+    """
+    async with session_lock(session_id), pinned_session(session_id):
+        chat_history = await aget_session_history(session_id)
+        history_len = len(chat_history.messages)
+        await asave_message(session_id, "human", input_text)
+
+        start = time.perf_counter()
+        first_token_at = None
+        parts = []
+        completed = False
+        try:
+            async for chunk in conversational_rag_chain.astream(
+                    {"input": input_text},
+                    config={"configurable": {"session_id": session_id}}
+            ):
+                token = chunk.get("answer")
+                if token:
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                    parts.append(token)
+                    yield token
+            completed = True
+        finally:
+            answer = "".join(parts)
+            if not completed and len(chat_history.messages) == history_len:
+                # 流被中断时 RunnableWithMessageHistory 不会更新内存历史，手动补上，与数据库保持一致
+                chat_history.add_user_message(input_text)
+                if answer:
+                    chat_history.add_ai_message(answer)
+            if answer:
+                # shield：调用方取消时也要把已生成的部分答案写完
+                await asyncio.shield(asave_message(session_id, "ai", answer))
+            metrics = {
+                "session_id": session_id,
+                "ttft": None if first_token_at is None else first_token_at - start,
+                "total": time.perf_counter() - start,
+                "chunks": len(parts),
+                "completed": completed,
+            }
+            turn_metrics.append(metrics)
+            print(f"astream_and_save:{metrics}")
+
+
 class EmbeddingGenerator:
-    def __init__(self, model_name="text-embedding-v2"):
+    def __init__(self, model_name="text-embedding-v2", batch_size=25, max_workers=4, max_retries=3,
+                 retry_backoff=1.0, query_max_wait=0.005):
+        """
+        :param batch_size: 单次请求打包的文本条数，DashScope text-embedding-v1/v2 上限为 25，v3 为 10
+        :param max_workers: 同时在途的批次数
+        :param max_retries: 单个批次失败后的最大重试次数
+        :param retry_backoff: 重试的基础退避时间（秒），按 2 的指数增长
+        :param query_max_wait: 并发的 embed_query 最多等待多久（秒）合并成一次请求
+        """
         self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.query_batcher = QueryBatcher(self._embed_batch, max_batch=batch_size, max_wait=query_max_wait,
+                                          max_in_flight=max_workers)
+
+    def _embed_batch(self, batch):
+        """
+        对一个批次调用一次 TextEmbedding.call，按 text_index 回填结果。
+        只对缺失的条目进行重试，重试用尽后抛出异常，而不是填充零向量。
+        """
+        results = [None] * len(batch)
+        pending = list(range(len(batch)))
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.retry_backoff * (2 ** (attempt - 1)))
+            try:
+                response = TextEmbedding.call(
+                    model=self.model_name,
+                    input=[batch[i] for i in pending]
+                )
+            except Exception as e:
+                print(f"Embedding request failed (attempt {attempt + 1}): {e}")
+                continue
+            if response.status_code != 200:
+                print(f"Embedding request failed (attempt {attempt + 1}): {response.status_code} {response.message}")
+                continue
+            for item in response.output['embeddings']:
+                results[pending[item['text_index']]] = item['embedding']
+            pending = [i for i in pending if results[i] is None]
+            if not pending:
+                return results
+        raise RuntimeError(f"Failed to embed {len(pending)} texts after {self.max_retries} retries")
 
     def embed_documents(self, texts):
-        embeddings = []
-        for text in texts:
-            response = TextEmbedding.call(
-                model=self.model_name,
-                input=text
-            )
-            if response.status_code == 200:
-                embeddings.append([item['embedding'] for item in response.output['embeddings']][0])
-            else:
-                # 如果获取嵌入失败，返回一个零向量
-                embeddings.append([0] * 1024)  # 假设嵌入向量维度为 1024
-        return embeddings
+        """
+        将文本按 batch_size 分批，最多 max_workers 个批次并发请求，结果顺序与输入保持一致。
+        """
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            batch_results = list(pool.map(self._embed_batch, batches))
+        return [embedding for batch in batch_results for embedding in batch]
 
     def embed_query(self, query):
-        # 使用相同的处理逻辑，只是这次只为单个查询处理
-        response = TextEmbedding.call(
-            model=self.model_name,
-            input=query
-        )
-        if response.status_code == 200:
-            return [item['embedding'] for item in response.output['embeddings']][0]
-        return [0] * 1024  # 如果获取嵌入失败，返回零向量
+        # 并发请求中的查询合并成一次 TextEmbedding.call，失败时与 embed_documents 一样重试后抛出异常
+        return self.query_batcher.embed(query)
+
+    async def aembed_query(self, query):
+        return await self.query_batcher.aembed(query)
 
 
 if __name__ == '__main__':
@@ -216,8 +820,9 @@ if __name__ == '__main__':
     DATABASE_URL = "sqlite:///chat_history.db"
 
     # Step 3. 创建模型类. 官网：https://docs.sqlalchemy.org/en/20/orm/quickstart.html
-    engine = create_engine(DATABASE_URL)
+    engine = create_chat_engine(DATABASE_URL)
     Base.metadata.create_all(engine)
+    migrate_chat_schema(engine)
 
     # Step 4. 构建Session 来管理会话。官方Docs：https://docs.sqlalchemy.org/en/20/orm/session_basics.html
     SessionLocal = sessionmaker(bind=engine)
@@ -225,10 +830,15 @@ if __name__ == '__main__':
     # 使用 atexit 模块来注册一个函数 save_all_sessions，这个函数将在Python程序即将正常终止时自动执行。目的是在程序退出前保存所有会话数据，以确保不会因程序突然终止而丢失数据。
     import atexit
 
+    # 后台批量写入消息；atexit 按注册的逆序执行，先运行 save_all_sessions，再由 close() 把队列中剩余的消息写完
+    message_writer = MessageWriter(SessionLocal)
+    atexit.register(message_writer.close)
     atexit.register(save_all_sessions)
 
     ### Construct retriever ###
-    loader = WebBaseLoader(
+    # 并发抓取 + 本地 HTTP 缓存：再次启动时用 ETag/Last-Modified 条件请求，未变化的页面不再下载；
+    # 设置 offline=True 可以只从缓存加载
+    loader = CachedWebLoader(
         web_paths=("https://lilianweng.github.io/posts/2023-06-23-agent/",),
         bs_kwargs=dict(
             parse_only=bs4.SoupStrainer(
@@ -236,29 +846,39 @@ if __name__ == '__main__':
             )
         ),
     )
-    docs = loader.load()
 
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    splits = text_splitter.split_documents(docs)
-    # 创建嵌入生成器实例
-    embedding_generator = EmbeddingGenerator(model_name="embedding-2")
-
-    # 文本列表
-    texts = [content for document in splits for split_type, content in document if split_type == 'page_content']
+    # 创建嵌入生成器实例，并在前面挂一层磁盘缓存：文档未变化时重建索引不再调用嵌入接口
+    embedding_generator = CachedEmbeddings(EmbeddingGenerator(model_name="embedding-2"), model_name="embedding-2")
 
-    # 创建 Chroma VectorStore
+    # 创建持久化的 Chroma VectorStore，进程重启后索引仍然保留
     chroma_store = Chroma(
         collection_name="example_collection",
         embedding_function=embedding_generator,  # 使用定义的嵌入生成器实例
+        persist_directory="./chroma_db",
         create_collection_if_not_exists=True
     )
 
-    # 添加文本到 Chroma VectorStore
-    IDs = chroma_store.add_texts(texts=texts)
-    # print("Added documents with IDs:", IDs)
+    # 增量索引：只切分指纹变化的文档，只写入新增/变化的切片，并删除已不存在的切片
+    indexer = IncrementalIndexer(chroma_store, text_splitter, manifest_path="./chroma_db/index_manifest.json")
+    # 流式导入：加载、切分、批量嵌入、写入通过有界队列并行推进，不再把整个语料一次性放进内存
+    ingest_pipeline = IngestPipeline(
+        text_splitter, embedding_generator,
+        upsert=chroma_upsert(chroma_store),
+        delete=lambda ids: chroma_store.delete(ids=ids),
+        indexer=indexer,
+    )
+    print("Ingest:", ingest_pipeline.run(loader.alazy_load(), cleanup=True))
+    print("Embedding cache:", embedding_generator.cache.stats())
 
-    # 使用 Chroma VectorStore 创建检索器
-    retriever = chroma_store.as_retriever()
+    # 混合检索器：对索引中的同一批切片建 BM25 倒排索引，与 Chroma 向量检索做 RRF 融合；
+    # 词法命中足够明确时直接返回，不再计算查询向量
+    stored = chroma_store.get(include=["documents", "metadatas"])
+    splits = [
+        Document(page_content=text, metadata=metadata or {}, id=_id)
+        for _id, text, metadata in zip(stored["ids"], stored["documents"], stored["metadatas"])
+    ]
+    retriever = HybridRetriever.from_documents(chroma_store, splits, k=4)
 
     ### Contextualize question ###
     contextualize_q_system_prompt = """Given a chat history and the latest user question \
@@ -275,9 +895,8 @@ if __name__ == '__main__':
     # (1) 用 LLM 改写问题  (2) 用改写后的问题去向量检索
     # 真正去 Chroma 查的，是“改写后的问题”，不是原问题
 
-    history_aware_retriever = create_history_aware_retriever(
-        chat, retriever, contextualize_q_prompt
-    )
+    # 历史为空，或问题中没有指代前文的代词时，跳过 LLM 改写直接检索，省掉一次模型往返
+    standalone_question_chain = create_standalone_question_chain(chat, contextualize_q_prompt)
 
     ### Answer question ###
     qa_system_prompt = """You are an assistant for question-answering tasks. \
@@ -307,7 +926,11 @@ if __name__ == '__main__':
     #
     # Human:
     # What is Task Decomposition?
-    question_answer_chain = create_stuff_documents_chain(chat, qa_prompt)
+    # 塞进 prompt 之前先打包上下文：合并相邻/重叠切片、去掉近似重复段落，并控制在 token 预算内
+    question_answer_chain = (
+        RunnablePassthrough.assign(context=lambda x: pack_context(x["context"], max_tokens=3000))
+        | create_stuff_documents_chain(chat, qa_prompt)
+    )
 
     # 用户输入
     # ↓
@@ -326,10 +949,17 @@ if __name__ == '__main__':
     #     answer = question_answer_chain(input, docs)
     #     return answer
 
-    rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
+    # 在检索和生成前面加一层语义答案缓存：独立问题与缓存问题足够相似且索引未变化时直接返回缓存答案
+    answer_cache = SemanticAnswerCache(embedding_generator, threshold=0.92, max_entries=1000)
+    rag_chain = create_cached_retrieval_chain(
+        standalone_question_chain, retriever, question_answer_chain, answer_cache,
+        get_index_version=lambda: indexer.version,
+    )
 
     ### Statefully manage chat history ###
-    store = {}
+    # 有界会话缓存：最多 1000 个会话 / 约 64MB，空闲 30 分钟淘汰，淘汰前持久化未保存的消息
+    store = SessionCache(max_entries=1000, max_bytes=64 * 1024 * 1024, ttl=30 * 60,
+                         on_evict=persist_evicted_session)
 
     # 实际执行顺序（非常重要）
     # 1.
@@ -359,8 +989,33 @@ if __name__ == '__main__':
     result = invoke_and_save("abc123", "What is Task Decomposition?")
     print(result)
 
-    # 此命令指示 vectorstore 删除其保存的整个数据集合。这里的集合是指所有文档（文本片段）及其相应的已被索引并存储在向量存储中的向量表示的集合。
-    chroma_store.delete_collection()
+    # 异步版本：同一个事件循环并发服务多个会话
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+
+    async_engine = create_async_chat_engine("sqlite+aiosqlite:///chat_history.db")
+    AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
+
+
+    async def serve_concurrently():
+        answers = await asyncio.gather(
+            ainvoke_and_save("async-1", "What is Task Decomposition?"),
+            ainvoke_and_save("async-2", "What are the types of agent memory?"),
+        )
+        # 流式输出：边生成边打印
+        async for token in astream_and_save("async-1", "What are common ways of doing it?"):
+            print(token, end="", flush=True)
+        print()
+        print("Question rewrites:", rewrite_stats)
+        print("Answer cache:", answer_cache.stats())
+        print("Retriever:", retriever.stats)
+        await async_engine.dispose()
+        return answers
+
+
+    for answer in asyncio.run(serve_concurrently()):
+        print(answer)
+
+    # 索引已持久化到 ./chroma_db，不再在退出时 delete_collection()，下次启动只同步变化的部分
 
 # 整体 RAG + 多轮对话架构图（逻辑视图）
 # ┌──────────────────────────┐
@@ -1,19 +1,39 @@
+import asyncio
 import os
+import time
 
 import bs4
-from langchain import hub
-from langchain_chroma import Chroma
+import numpy as np
 from langchain_community.chat_models import ChatTongyi
-from langchain_community.document_loaders import WebBaseLoader
 from langchain_community.embeddings import DashScopeEmbeddings
+from langchain_community.embeddings.dashscope import embed_with_retry
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnablePassthrough
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+from utils.context_packing import pack_context
+from utils.embedding_batcher import QueryBatcher
+from utils.embedding_cache import CachedEmbeddings
+from utils.incremental_index import IncrementalIndexer
+from utils.web_loader import CachedWebLoader
+from vector.numpy_store import NumpyVectorStore
+
 DASHSCOPE_API_KEY = os.getenv('DASHSCOPE_API_KEY')
 
 DASHSCOPE_API_KEY = os.getenv('DASHSCOPE_API_KEY')
 
+NUMPY_INDEX_PATH = "./numpy_index"
+WEB_PATHS = ("https://lilianweng.github.io/posts/2023-06-23-agent/",)
+
+# hub.pull("rlm/rag-prompt") 的内容，直接内置，启动时不再访问网络
+RAG_PROMPT = ChatPromptTemplate.from_messages([(
+    "human",
+    "You are an assistant for question-answering tasks. Use the following pieces of retrieved context to answer "
+    "the question. If you don't know the answer, just say that you don't know. Use three sentences maximum and "
+    "keep the answer concise.\nQuestion: {question} \nContext: {context} \nAnswer:",
+)])
+
 # 1. 初始化通义千问 Embedding 模型
 embeddings_model = DashScopeEmbeddings(
     model="text-embedding-v3",  # 指定模型版本
@@ -28,63 +48,181 @@ llm  = ChatTongyi(
 )
 
 class EmbeddingGenerator:
-    def __init__(self, model_name):
+    def __init__(self, model_name, query_max_batch=10, query_max_wait=0.005):
+        """
+        :param query_max_batch: 合并后单次请求的查询条数，text-embedding-v3 上限为 10
+        :param query_max_wait: 并发的 embed_query 最多等待多久（秒）合并成一次请求
+        """
         self.model_name = model_name
         self.client = embeddings_model
+        self.query_batcher = QueryBatcher(self._embed_queries, max_batch=query_max_batch, max_wait=query_max_wait)
+
+    def _embed_queries(self, texts):
+        # 与 DashScopeEmbeddings.embed_query 相同使用 text_type="query"，只是一次请求多条；
+        # embed_with_retry 返回的结果已经按输入顺序排列（text_index 只在每个子批次内编号，不能用来排序）
+        results = embed_with_retry(self.client, input=texts, text_type="query", model=self.model_name)
+        return [item["embedding"] for item in results]
 
     def embed_documents(self, texts):
-        embeddings = []
-        for text in texts:
-            response = self.client.embed_documents(text)
-            embeddings.append(response.data[0])
-        return embeddings
+        # DashScopeEmbeddings 内部已按接口上限分批请求
+        return self.client.embed_documents(list(texts))
 
     def embed_query(self, query):
-        # 使用相同的处理逻辑，只是这次只为单个查询处理
-        response = self.client.embed_query(query)
-        if hasattr(response, 'data') and response.data:
-            return response.data[0].embedding
-        return [0] * 1024  # 如果获取嵌入失败，返回零向量
-
-def call():
-    embeddings = []
-    loader = WebBaseLoader(
-        web_path="https://lilianweng.github.io/posts/2023-06-23-agent/",
-        bs_kwargs=dict(
-            parse_only=bs4.SoupStrainer(
-                class_ = ("post-content","post-title","post-header")
+        return self.query_batcher.embed(query)
+
+    def embed_queries(self, queries):
+        # 全部提交给 query_batcher，按 text_type="query" 合并成若干次请求
+        futures = [self.query_batcher.submit(query) for query in queries]
+        return [future.result() for future in futures]
+
+    async def aembed_query(self, query):
+        return await self.query_batcher.aembed(query)
+
+
+# 磁盘缓存包装：相同文本在同一模型下只嵌入一次；未命中的并发查询由 EmbeddingGenerator 合并请求
+cached_embeddings_model = CachedEmbeddings(EmbeddingGenerator("text-embedding-v3"), model_name="text-embedding-v3")
+
+
+def format_docs(docs):
+    # 合并相邻/重叠切片、去掉近似重复段落，并控制在 token 预算内
+    return "\n\n".join(doc.page_content for doc in pack_context(docs, max_tokens=3000))
+
+
+class NativeRagPipeline:
+    """
+    常驻的 RAG 管道：索引、检索器和链只构建一次，之后反复回答问题。
+    已有持久化索引时直接 memmap 加载，不抓取网页也不重新嵌入；refresh=True 时重新抓取（条件请求），按 manifest 增量写入变化的切片并删除失效的切片。
+
+    :param max_concurrency: batch / abatch 同时进行的 LLM 调用数
+    """
+
+    def __init__(self, web_paths=WEB_PATHS, index_path=NUMPY_INDEX_PATH, embeddings=cached_embeddings_model,
+                 chat_model=llm, prompt=RAG_PROMPT, k=4, max_concurrency=8, refresh=False):
+        self.web_paths = web_paths
+        self.index_path = index_path
+        self.embeddings = embeddings
+        self.k = k
+        self.max_concurrency = max_concurrency
+        self.latencies = []
+
+        start = time.perf_counter()
+        self.vector_store = self._open_index(refresh)
+        self.retriever = self.vector_store.as_retriever(search_kwargs={"k": k})
+        # 检索之后的部分单独成链，batch 时可以先一次性检索全部问题
+        self.answer_chain = prompt | chat_model | StrOutputParser()
+        self.rag_chain = (
+            {"context": self.retriever | format_docs, "question": RunnablePassthrough()}
+            | self.answer_chain
+        )
+        self.cold_start_seconds = time.perf_counter() - start
+
+    def _open_index(self, refresh):
+        if not refresh and os.path.exists(os.path.join(self.index_path, "vectors.npy")):
+            return NumpyVectorStore.load(self.index_path, self.embeddings)
+        # 并发抓取 + 本地 HTTP 缓存，页面未变化时不再重复下载
+        loader = CachedWebLoader(
+            web_paths=self.web_paths,
+            bs_kwargs=dict(
+                parse_only=bs4.SoupStrainer(
+                    class_=("post-content", "post-title", "post-header")
+                )
+            ),
+        )
+        docs = loader.load()
+
+        if os.path.exists(os.path.join(self.index_path, "vectors.npy")):
+            vector_store = NumpyVectorStore.load(self.index_path, self.embeddings)
+        else:
+            vector_store = NumpyVectorStore(self.embeddings)
+        # manifest 记录每个页面的指纹和切片 id：只写入新增/变化的切片，删除页面上已经不存在的切片
+        indexer = IncrementalIndexer(
+            vector_store, RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200),
+            manifest_path=os.path.join(self.index_path, "manifest.json"),
+        )
+        new_chunks, stale_ids = {}, []
+        for doc in docs:
+            changes = indexer.diff(doc)
+            if changes is not None:
+                new_chunks.update(changes[0])
+                stale_ids.extend(changes[1])
+        stale_ids.extend(indexer.remove_missing(str(doc.metadata.get("source", "")) for doc in docs))
+        if not new_chunks and not stale_ids:
+            # 没有任何变化时不重写索引文件
+            return vector_store
+
+        vector_store.delete(ids=stale_ids)
+        if new_chunks:
+            vector_store.add_texts(
+                texts=[split.page_content for split in new_chunks.values()],
+                metadatas=[split.metadata for split in new_chunks.values()],
+                ids=list(new_chunks),
             )
-        ),
-    )
+        # 先保存向量库再保存 manifest：中途失败时下次刷新会重新写入这些切片
+        vector_store.save(self.index_path)
+        indexer.save()
+        return vector_store
+
+    def _record(self, seconds, count=1):
+        self.latencies.extend([seconds / count] * count)
+
+    def invoke(self, question):
+        start = time.perf_counter()
+        answer = self.rag_chain.invoke(question)
+        self._record(time.perf_counter() - start)
+        return answer
+
+    async def ainvoke(self, question):
+        start = time.perf_counter()
+        answer = await self.rag_chain.ainvoke(question)
+        self._record(time.perf_counter() - start)
+        return answer
+
+    def _inputs(self, questions, docs_per_question):
+        return [{"context": format_docs(docs), "question": question}
+                for question, docs in zip(questions, docs_per_question)]
+
+    def batch(self, questions):
+        """
+        全部问题按查询类型合并嵌入、一次矩阵乘法检索，再并发调用 LLM。
+        """
+        questions = list(questions)
+        start = time.perf_counter()
+        docs_per_question = self.vector_store.batch_similarity_search(questions, k=self.k)
+        answers = self.answer_chain.batch(self._inputs(questions, docs_per_question),
+                                          config={"max_concurrency": self.max_concurrency})
+        self._record(time.perf_counter() - start, len(questions))
+        return answers
+
+    async def abatch(self, questions):
+        questions = list(questions)
+        start = time.perf_counter()
+        docs_per_question = await asyncio.to_thread(self.vector_store.batch_similarity_search, questions, self.k)
+        answers = await self.answer_chain.abatch(self._inputs(questions, docs_per_question),
+                                                 config={"max_concurrency": self.max_concurrency})
+        self._record(time.perf_counter() - start, len(questions))
+        return answers
+
+    def latency_report(self):
+        """
+        冷启动（构建或加载索引、组装链）与热态单问题延迟分开统计；batch 中的问题按平均耗时计入。
+        """
+        report = {"cold_start_seconds": round(self.cold_start_seconds, 3), "questions": len(self.latencies)}
+        if self.latencies:
+            report["warm_p50_seconds"] = round(float(np.percentile(self.latencies, 50)), 3)
+            report["warm_p99_seconds"] = round(float(np.percentile(self.latencies, 99)), 3)
+        return report
 
-    docs = loader.load()
-    text_spliter = RecursiveCharacterTextSplitter(chunk_size=1000,chunk_overlap=200)
-    splits = text_spliter.split_documents(docs)
 
-    texts = [content for document in splits for split_type, content in document if split_type == 'page_content']
-    chroma_store = Chroma(
-        collection_name="example_collection",
-        embedding_function=embeddings_model,  # 使用定义的嵌入生成器实例
-        create_collection_if_not_exists=True
-    )
-    IDs = chroma_store.add_texts(texts=texts)
-
-    retriever = chroma_store.as_retriever()
-
-    prompt = hub.pull("rlm/rag-prompt")
-
-    def format_docs(docs):
-        return "\n\n".join(doc.page_content for doc in docs)
-
-    rag_chain = (
-             {"context": retriever | format_docs, "question": RunnablePassthrough()}
-             | prompt
-             | llm
-             | StrOutputParser()
-         )
+def call():
+    pipeline = NativeRagPipeline()
+    print("Embedding cache:", cached_embeddings_model.cache.stats())
 
-    rag_res = rag_chain.invoke("What is Task Decomposition?")
+    rag_res = pipeline.invoke("What is Task Decomposition?")
     print(rag_res)
+    for answer in pipeline.batch(["What is Task Decomposition?", "What are the types of agent memory?",
+                                  "How does ReAct combine reasoning and acting?"]):
+        print(answer)
+    print("Latency:", pipeline.latency_report())
     # for doc_splits in splits:
     #     for split_type, split_content in doc_splits:
     #         if split_type == 'page_content' and split_content.strip():
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : context_packing.py
+上下文打包：在把检索结果塞进 stuff-documents prompt 之前，合并同一来源中相邻/重叠的切片，
+去掉近似重复的段落，并按相关度顺序填满 token 预算。
+"""
+import re
+
+from langchain_core.documents import Document
+
+from utils.tokens import estimate_tokens
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+def _shingles(text, size=3):
+    words = _WORD_PATTERN.findall(text.lower())
+    if len(words) < size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def _containment(a, b):
+    """
+    a 中有多大比例的词三元组已经出现在 b 中。
+    """
+    if not a:
+        return 1.0
+    return len(a & b) / len(a)
+
+
+def _overlap_merge(first, second, min_overlap):
+    """
+    first 的结尾与 second 的开头重叠至少 min_overlap 个字符时返回拼接后的文本，否则返回 None。
+    """
+    probe = second[:min_overlap]
+    if len(probe) < min_overlap:
+        return None
+    start = first.find(probe)
+    while start != -1:
+        tail = first[start:]
+        if second.startswith(tail):
+            return first + second[len(tail):]
+        start = first.find(probe, start + 1)
+    return None
+
+
+def _merge(a, b, min_overlap):
+    """
+    合并两段文本：包含关系直接取较长者，首尾重叠则拼接，否则返回 None。
+    """
+    if b in a:
+        return a
+    if a in b:
+        return b
+    return _overlap_merge(a, b, min_overlap) or _overlap_merge(b, a, min_overlap)
+
+
+def pack_context(docs, max_tokens=3000, dedup_threshold=0.8, min_overlap=50):
+    """
+    :param docs: 按相关度降序排列的文档
+    :param max_tokens: 打包后的上下文 token 上限
+    :param dedup_threshold: 词三元组被某个已选段落覆盖的比例达到该值即视为近似重复
+    :param min_overlap: 同一来源的两个切片至少重叠多少字符才合并
+    :return: 按相关度排列的文档列表，合并后的段落保留较相关切片的位置和元数据
+    """
+    passages = []  # [source, text, metadata, shingles]
+    used_tokens = 0
+    for doc in docs:
+        text = doc.page_content
+        source = doc.metadata.get("source")
+        merged = False
+        for passage in passages:
+            if passage[0] != source:
+                continue
+            combined = _merge(passage[1], text, min_overlap)
+            if combined is None:
+                continue
+            extra = estimate_tokens(combined) - estimate_tokens(passage[1])
+            if used_tokens + extra <= max_tokens:
+                used_tokens += extra
+                passage[1] = combined
+                passage[3] = _shingles(combined)
+            merged = True
+            break
+        if merged:
+            continue
+
+        shingles = _shingles(text)
+        if any(_containment(shingles, passage[3]) >= dedup_threshold for passage in passages):
+            continue
+        tokens = estimate_tokens(text)
+        if used_tokens + tokens > max_tokens:
+            # 放不下就跳过，继续尝试后面更短的段落
+            continue
+        used_tokens += tokens
+        passages.append([source, text, doc.metadata, shingles])
+
+    return [Document(page_content=text, metadata=metadata) for _, text, metadata, _ in passages]
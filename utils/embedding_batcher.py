@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : embedding_batcher.py
+查询嵌入的微批合并：并发到达的 embed_query 请求在 max_wait 秒内攒成一批，
+去重后用一次 embed_documents 请求完成，再把结果分发回各个等待的调用方。
+"""
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+_STOP = object()
+
+
+class QueryBatcher:
+    """
+    :param embed_many: 一次嵌入多条文本的函数，例如 EmbeddingGenerator._embed_batch 或 embeddings.embed_documents
+    :param max_batch: 每批最多的请求数（去重前），应不超过模型单次请求的条数上限
+    :param max_wait: 收到第一条请求后最多等待多久（秒）再发出，是延迟与合并率之间的取舍
+    :param max_in_flight: 同时在途的批次数；全部在途时新请求继续排队，下一批会更大
+    """
+
+    def __init__(self, embed_many, max_batch=10, max_wait=0.005, max_in_flight=4):
+        self.embed_many = embed_many
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._pool = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="query-batcher")
+        self._worker = None
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "batches": 0, "embedded": 0}
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="query-batcher", daemon=True)
+                self._worker.start()
+
+    def submit(self, text) -> Future:
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def embed(self, text):
+        return self.submit(text).result()
+
+    async def aembed(self, text):
+        return await asyncio.wrap_future(self.submit(text))
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self._queue.put(_STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while (first := self._queue.get()) is not _STOP:
+            # 在途批次已满时先在这里等待，期间到达的请求留在队列中，有空位后合并成更大的一批
+            self._slots.acquire()
+            self._pool.submit(self._flush, self._collect(first))
+
+    def _flush(self, batch):
+        try:
+            texts = list(dict.fromkeys(text for text, _ in batch))
+            with self._lock:
+                self.stats["requests"] += len(batch)
+                self.stats["batches"] += 1
+                self.stats["embedded"] += len(texts)
+            try:
+                results = list(self.embed_many(texts))
+                if len(results) != len(texts):
+                    raise ValueError(f"Expected {len(texts)} embeddings, got {len(results)}")
+                vectors = dict(zip(texts, results))
+                for text, future in batch:
+                    future.set_result(vectors[text])
+            except Exception as e:
+                # 任何失败都要让尚未完成的调用方收到异常，否则它们会在 result() 上永远等待
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """
+        发完队列中剩余的请求后停止后台线程。
+        """
+        if self._worker is not None:
+            self._queue.put(_STOP)
+            self._worker.join()
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : embedding_cache.py
+基于 SQLite 的持久化嵌入缓存，以 (模型名, 嵌入类型, 文本 sha256) 为键，向量按 float32 存储，LRU 淘汰。
+嵌入类型区分 "document" 和 "query"：同一段文本按查询和按文档嵌入得到的向量不同，不能共用缓存。
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+from array import array
+
+from langchain_core.embeddings import Embeddings
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    内容寻址的磁盘缓存。同一段文本在同一个模型下只需要调用一次嵌入接口。
+    """
+
+    def __init__(self, path="embedding_cache.db", max_entries=200_000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(embeddings)")}
+        if columns and "kind" not in columns:
+            # 旧版缓存的键里没有嵌入类型，查询向量和文档向量混在一起无法区分，整体丢弃
+            self._conn.execute("DROP TABLE embeddings")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL,"
+            " kind TEXT NOT NULL,"
+            " text_hash TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (model, kind, text_hash))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def get_many(self, model, texts, kind="document"):
+        """
+        批量查询，未命中的位置返回 None，命中的条目刷新 last_used。
+        """
+        hashes = [text_hash(text) for text in texts]
+        found = {}
+        with self._lock:
+            unique = list(set(hashes))
+            # SQLite 默认最多 999 个绑定参数，分段查询
+            for i in range(0, len(unique), 900):
+                chunk = unique[i:i + 900]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings "
+                    f"WHERE model = ? AND kind = ? AND text_hash IN ({placeholders})",
+                    [model, kind, *chunk],
+                ).fetchall()
+                for h, blob in rows:
+                    vector = array("f")
+                    vector.frombytes(blob)
+                    found[h] = vector.tolist()
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND kind = ? AND text_hash = ?",
+                    [(now, model, kind, h) for h in found],
+                )
+                self._conn.commit()
+            hits = sum(1 for h in hashes if h in found)
+            self.hits += hits
+            self.misses += len(hashes) - hits
+        return [found.get(h) for h in hashes]
+
+    def put_many(self, model, texts, vectors, kind="document"):
+        now = time.time()
+        rows = [(model, kind, text_hash(text), array("f", vector).tobytes(), now)
+                for text, vector in zip(texts, vectors)]
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (model, kind, text_hash, vector, last_used) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._size += self._conn.total_changes - before
+            overflow = self._size - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE rowid IN "
+                    "(SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (overflow,),
+                )
+                self._size -= overflow
+                self.evictions += overflow
+            self._conn.commit()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": self._size}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    包装任意提供 embed_documents / embed_query 的嵌入实现（EmbeddingGenerator、DashScopeEmbeddings 等），
+    只把缓存未命中的文本交给底层模型。
+    """
+
+    def __init__(self, embeddings, model_name, cache=None):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.cache = cache if cache is not None else EmbeddingCache()
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        vectors = self.cache.get_many(self.model_name, texts)
+        # 同一批次内重复的文本只请求一次
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            computed = dict(zip(missing, self.embeddings.embed_documents(missing)))
+            self.cache.put_many(self.model_name, missing, [computed[text] for text in missing])
+            vectors = [vector if vector is not None else computed[text] for text, vector in zip(texts, vectors)]
+        return vectors
+
+    def embed_queries(self, texts):
+        """
+        批量嵌入查询：未命中的查询交给底层的 embed_queries（没有时逐条 embed_query）。
+        """
+        texts = list(texts)
+        vectors = self.cache.get_many(self.model_name, texts, kind="query")
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            if hasattr(self.embeddings, "embed_queries"):
+                computed = dict(zip(missing, self.embeddings.embed_queries(missing)))
+            else:
+                computed = {text: self.embeddings.embed_query(text) for text in missing}
+            self.cache.put_many(self.model_name, missing, [computed[text] for text in missing], kind="query")
+            vectors = [vector if vector is not None else computed[text] for text, vector in zip(texts, vectors)]
+        return vectors
+
+    def embed_query(self, text):
+        return self.embed_queries([text])[0]
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : history_aware.py
+带旁路的独立问题改写：问题本身已经可以独立理解时，跳过用 LLM 改写问题这一步，直接使用原问题。
+"""
+import re
+
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
+
+# 改写次数统计：skipped 为跳过改写，performed 为调用了 LLM 改写
+rewrite_stats = {"skipped": 0, "performed": 0}
+
+# 指代前文的英文代词 / 短语
+_EN_REFERENCE = re.compile(
+    r"\b(it|its|this|that|these|those|they|them|their|he|him|his|she|her|one|ones|former|latter|"
+    r"above|previous|previously|earlier|mentioned|same|else|more|again|also|too)\b"
+    r"|^(and|but|so|or|what about|how about|why not|then)\b",
+    re.IGNORECASE,
+)
+# 指代前文的中文代词 / 短语
+_ZH_REFERENCE = re.compile(r"它|他|她|这个|那个|这些|那些|这种|那种|其|该|上面|上述|之前|刚才|前面|刚刚|还有|那么|呢")
+# 过短的问题（如 "why?"、"为什么"）一般都是追问
+_MIN_STANDALONE_CHARS = 12
+
+
+def needs_rewrite(question: str, chat_history) -> bool:
+    """
+    本地的廉价判断：没有历史，或者问题中没有代词和对前文的引用时，不需要改写。
+    """
+    if not chat_history:
+        return False
+    text = question.strip()
+    if len(text) < _MIN_STANDALONE_CHARS:
+        return True
+    return bool(_EN_REFERENCE.search(text) or _ZH_REFERENCE.search(text))
+
+
+def create_standalone_question_chain(llm, prompt):
+    """
+    {"input", "chat_history"} -> 可以独立理解的问题。只在 needs_rewrite 为真时才调用 LLM 改写。
+    """
+    if "input" not in prompt.input_variables:
+        raise ValueError(f"Expected `input` to be a prompt variable, but got {prompt.input_variables}")
+
+    rewrite = prompt | llm | StrOutputParser()
+    passthrough = RunnableLambda(lambda x: x["input"])
+
+    def route(inputs):
+        if needs_rewrite(inputs["input"], inputs.get("chat_history")):
+            rewrite_stats["performed"] += 1
+            return rewrite
+        rewrite_stats["skipped"] += 1
+        return passthrough
+
+    return RunnableLambda(route).with_config(run_name="standalone_question")
+
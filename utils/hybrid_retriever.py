@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : hybrid_retriever.py
+混合检索：进程内 BM25 倒排索引 + 向量检索，用倒数排名融合（RRF）合并结果。
+词法检索的第一名足够明确时直接返回，连查询向量都不用计算。
+"""
+import asyncio
+import math
+import re
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
+
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict, Field
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+|[\u4e00-\u9fff]")
+_STOPWORDS = frozenset(
+    "a an and are as at be by do does for from how in is it of on or that the this to was what when where which "
+    "who why with 的 了 是 在 和 吗 呢 什么".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    英文按单词、中文按单字切分，并去掉常见停用词。
+    """
+    return [token for token in _TOKEN_PATTERN.findall(text.lower()) if token not in _STOPWORDS]
+
+
+class BM25Index:
+    """
+    紧凑的 BM25 倒排索引：每个词项的倒排表是两个 numpy 数组（文档编号、词频），打分时按词项向量化累加。
+    """
+
+    def __init__(self, texts, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        postings = defaultdict(lambda: ([], []))
+        lengths = []
+        for doc_id, text in enumerate(texts):
+            counts = Counter(tokenize(text))
+            lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                doc_ids, tfs = postings[term]
+                doc_ids.append(doc_id)
+                tfs.append(tf)
+        self.size = len(lengths)
+        self.doc_lengths = np.asarray(lengths, dtype=np.float32)
+        avg_length = float(self.doc_lengths.mean()) if self.size else 0.0
+        # 预先计算每篇文档的长度归一化项
+        self._norms = k1 * (1 - b + b * self.doc_lengths / avg_length) if avg_length else self.doc_lengths
+        self.postings = {
+            term: (np.asarray(doc_ids, dtype=np.int32), np.asarray(tfs, dtype=np.float32))
+            for term, (doc_ids, tfs) in postings.items()
+        }
+
+    def idf(self, term):
+        df = len(self.postings[term][0])
+        return math.log(1 + (self.size - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, k: int):
+        """
+        返回 [(文档编号, 分数), ...]，按分数降序；以及查询中有多少词项出现在第一名文档里。
+        """
+        terms = [term for term in set(tokenize(query)) if term in self.postings]
+        if not terms or not self.size:
+            return [], 0
+        scores = np.zeros(self.size, dtype=np.float32)
+        for term in terms:
+            doc_ids, tfs = self.postings[term]
+            scores[doc_ids] += self.idf(term) * tfs * (self.k1 + 1) / (tfs + self._norms[doc_ids])
+        k = min(k, int(np.count_nonzero(scores)))
+        if k == 0:
+            return [], 0
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        best = int(top[0])
+        matched = sum(1 for term in terms if best in self.postings[term][0])
+        return [(int(i), float(scores[i])) for i in top], matched
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    rankings 为若干个按相关度排序的键列表，返回融合后的键列表。
+    """
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            scores[key] += 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    对同一批切片同时做 BM25 和向量检索，RRF 融合后返回前 k 条。
+    decisive_ratio 不为 None 时，若词法结果至少有 k 条、第一名覆盖了查询的全部词项（包括索引中没有出现的词）
+    且分数至少是第二名的 decisive_ratio 倍，直接返回词法结果的前 k 条，跳过查询嵌入和向量检索；
+    否则与向量结果融合。为 None 时两路检索并行执行。
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    vectorstore: Any
+    documents: List[Document]
+    index: BM25Index
+    k: int = 4
+    fetch_k: int = 20
+    rrf_k: int = 60
+    decisive_ratio: Optional[float] = 2.0
+    stats: dict = Field(default_factory=lambda: {"lexical_only": 0, "hybrid": 0})
+
+    @classmethod
+    def from_documents(cls, vectorstore, documents, **kwargs):
+        documents = list(documents)
+        return cls(vectorstore=vectorstore, documents=documents,
+                   index=BM25Index([doc.page_content for doc in documents]), **kwargs)
+
+    def _lexical(self, query):
+        hits, matched = self.index.search(query, self.fetch_k)
+        # 分母是查询中全部的非停用词：索引里不存在的词说明词法检索没有理解这个查询，需要向量检索补充
+        query_terms = len(set(tokenize(query)))
+        decisive = (
+            self.decisive_ratio is not None
+            and len(hits) >= self.k
+            and matched == query_terms
+            and (len(hits) == 1 or hits[0][1] >= self.decisive_ratio * hits[1][1])
+        )
+        return [self.documents[i] for i, _ in hits], decisive
+
+    def _fuse(self, lexical_docs, vector_docs):
+        by_key = {}
+        rankings = []
+        for docs in (lexical_docs, vector_docs):
+            ranking = []
+            for doc in docs:
+                by_key.setdefault(doc.page_content, doc)
+                ranking.append(doc.page_content)
+            rankings.append(ranking)
+        return [by_key[key] for key in reciprocal_rank_fusion(rankings, self.rrf_k)[:self.k]]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        if self.decisive_ratio is None:
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                vector_future = pool.submit(self.vectorstore.similarity_search, query, k=self.fetch_k)
+                lexical_docs, _ = self._lexical(query)
+                vector_docs = vector_future.result()
+        else:
+            # BM25 在进程内、亚毫秒级完成，先用它判断是否需要付出一次嵌入调用
+            lexical_docs, decisive = self._lexical(query)
+            if decisive:
+                self.stats["lexical_only"] += 1
+                return lexical_docs[:self.k]
+            vector_docs = self.vectorstore.similarity_search(query, k=self.fetch_k)
+        self.stats["hybrid"] += 1
+        return self._fuse(lexical_docs, vector_docs)
+
+    async def _aget_relevant_documents(self, query: str, *,
+                                       run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        if self.decisive_ratio is None:
+            (lexical_docs, _), vector_docs = await asyncio.gather(
+                asyncio.to_thread(self._lexical, query),
+                self.vectorstore.asimilarity_search(query, k=self.fetch_k),
+            )
+        else:
+            lexical_docs, decisive = self._lexical(query)
+            if decisive:
+                self.stats["lexical_only"] += 1
+                return lexical_docs[:self.k]
+            vector_docs = await self.vectorstore.asimilarity_search(query, k=self.fetch_k)
+        self.stats["hybrid"] += 1
+        return self._fuse(lexical_docs, vector_docs)
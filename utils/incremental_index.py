@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : incremental_index.py
+增量索引：为每个文档和每个切片记录指纹，重新导入时只写入新增/变化的切片，并删除已经不存在的切片。
+"""
+import hashlib
+import json
+import os
+
+
+def document_fingerprint(doc) -> str:
+    payload = json.dumps(doc.metadata, sort_keys=True, ensure_ascii=False, default=str) + "\x00" + doc.page_content
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def chunk_id(source: str, text: str) -> str:
+    """
+    切片 id 由来源和切片内容派生，内容不变则 id 不变，可直接用作向量库主键。
+    """
+    return hashlib.sha256(f"{source}\x00{text}".encode("utf-8")).hexdigest()
+
+
+class IncrementalIndexer:
+    """
+    维护一个 manifest 文件（source -> 文档指纹 + 切片 id 列表），与持久化的向量库配合使用。
+    """
+
+    def __init__(self, vectorstore, text_splitter, manifest_path="index_manifest.json"):
+        self.vectorstore = vectorstore
+        self.text_splitter = text_splitter
+        self.manifest_path = manifest_path
+        self.manifest = self._load_manifest()
+        self.version = self._compute_version()
+
+    def _load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, encoding="utf-8") as f:
+                return json.load(f)
+        return {}
+
+    def _compute_version(self):
+        """
+        索引版本：所有切片 id 的摘要，索引内容有任何增删时都会变化。
+        """
+        digest = hashlib.sha256()
+        for source in sorted(self.manifest):
+            digest.update(source.encode("utf-8"))
+            for _id in sorted(self.manifest[source]["chunk_ids"]):
+                digest.update(_id.encode("ascii"))
+        return digest.hexdigest()
+
+    def _save_manifest(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.manifest_path)), exist_ok=True)
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
+
+    def diff(self, doc):
+        """
+        对比文档与 manifest，返回 (需要写入的 {切片 id: 切片}, 需要删除的切片 id 列表)，并更新内存中的 manifest。
+        文档指纹未变化时返回 None。
+        """
+        source = str(doc.metadata.get("source", ""))
+        fingerprint = document_fingerprint(doc)
+        previous = self.manifest.get(source)
+        if previous and previous["fingerprint"] == fingerprint:
+            return None
+
+        # 同一文档内重复的切片只保留一份
+        chunks = {}
+        for split in self.text_splitter.split_documents([doc]):
+            chunks.setdefault(chunk_id(source, split.page_content), split)
+        old_ids = set(previous["chunk_ids"]) if previous else set()
+        new_chunks = {_id: split for _id, split in chunks.items() if _id not in old_ids}
+        stale_ids = list(old_ids - chunks.keys())
+        self.manifest[source] = {"fingerprint": fingerprint, "chunk_ids": list(chunks)}
+        return new_chunks, stale_ids
+
+    def remove_missing(self, seen_sources):
+        """
+        从 manifest 中移除本次未出现的来源，返回它们的切片 id。
+        """
+        stale_ids = []
+        for source in list(self.manifest.keys() - set(seen_sources)):
+            stale_ids.extend(self.manifest.pop(source)["chunk_ids"])
+        return stale_ids
+
+    def save(self):
+        self._save_manifest()
+        self.version = self._compute_version()
+
+    def index(self, docs, cleanup=False):
+        """
+        :param docs: 本次导入的文档
+        :param cleanup: 为 True 时，manifest 中存在但本次未出现的来源会被整体删除
+        :return: 统计信息 {"added", "deleted", "unchanged_docs"}
+        """
+        stats = {"added": 0, "deleted": 0, "unchanged_docs": 0}
+        seen_sources = set()
+        for doc in docs:
+            seen_sources.add(str(doc.metadata.get("source", "")))
+            changes = self.diff(doc)
+            if changes is None:
+                stats["unchanged_docs"] += 1
+                continue
+            new_chunks, stale_ids = changes
+            if new_chunks:
+                self.vectorstore.add_texts(
+                    texts=[split.page_content for split in new_chunks.values()],
+                    metadatas=[split.metadata for split in new_chunks.values()],
+                    ids=list(new_chunks),
+                )
+            if stale_ids:
+                self.vectorstore.delete(ids=stale_ids)
+            stats["added"] += len(new_chunks)
+            stats["deleted"] += len(stale_ids)
+
+        if cleanup:
+            stale_ids = self.remove_missing(seen_sources)
+            if stale_ids:
+                self.vectorstore.delete(ids=stale_ids)
+            stats["deleted"] += len(stale_ids)
+
+        self.save()
+        return stats
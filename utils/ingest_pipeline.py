@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : ingest_pipeline.py
+流式导入流水线：加载 → 切分 → 批量嵌入 → 写入向量库，各阶段之间用有界队列连接。
+后面的文档还在加载时，前面的文档已经在切分、嵌入和写入；队列满时上游自动等待（背压），峰值内存与语料规模无关。
+"""
+import asyncio
+import time
+
+from utils.incremental_index import chunk_id
+
+_DONE = object()
+
+
+class StageCounter:
+    """
+    单个阶段的吞吐计数：处理条数和实际工作耗时（不含在队列上等待的时间）。
+    """
+
+    def __init__(self):
+        self.items = 0
+        self.busy_seconds = 0.0
+
+    def add(self, items, seconds):
+        self.items += items
+        self.busy_seconds += seconds
+
+    def as_dict(self):
+        rate = self.items / self.busy_seconds if self.busy_seconds else None
+        return {"items": self.items, "busy_seconds": round(self.busy_seconds, 3),
+                "items_per_sec": None if rate is None else round(rate, 1)}
+
+
+def chroma_upsert(vectorstore):
+    """
+    为 langchain_chroma.Chroma 生成 upsert 函数：直接写入已经算好的向量，不再二次嵌入。
+    """
+
+    def upsert(ids, texts, metadatas, vectors):
+        vectorstore._collection.upsert(ids=ids, documents=texts, metadatas=metadatas, embeddings=vectors)
+
+    return upsert
+
+
+class IngestPipeline:
+    """
+    :param text_splitter: 切分器
+    :param embeddings: 提供 embed_documents 的嵌入实现（可以是 CachedEmbeddings）
+    :param upsert: upsert(ids, texts, metadatas, vectors)，写入已嵌入的切片
+    :param delete: delete(ids)，删除失效的切片；配合 indexer 使用
+    :param indexer: 可选的 IncrementalIndexer，只嵌入和写入新增/变化的切片
+    :param batch_size: 每次嵌入请求的切片数
+    :param queue_size: 阶段之间队列的容量
+    """
+
+    def __init__(self, text_splitter, embeddings, upsert, delete=None, indexer=None, batch_size=64, queue_size=4):
+        self.text_splitter = text_splitter
+        self.embeddings = embeddings
+        self.upsert = upsert
+        self.delete = delete
+        self.indexer = indexer
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.counters = {name: StageCounter() for name in ("load", "split", "embed", "upsert")}
+
+    def stats(self):
+        return {name: counter.as_dict() for name, counter in self.counters.items()}
+
+    async def _load(self, documents, out):
+        start = time.perf_counter()
+        if hasattr(documents, "__aiter__"):
+            async for doc in documents:
+                self.counters["load"].add(1, time.perf_counter() - start)
+                await out.put(doc)
+                start = time.perf_counter()
+        else:
+            for doc in documents:
+                self.counters["load"].add(1, time.perf_counter() - start)
+                await out.put(doc)
+                start = time.perf_counter()
+        await out.put(_DONE)
+
+    def _split_one(self, doc):
+        """
+        返回 (需要嵌入的 [(id, 切片)], 需要删除的 ids)。
+        """
+        if self.indexer is not None:
+            changes = self.indexer.diff(doc)
+            if changes is None:
+                return [], []
+            new_chunks, stale_ids = changes
+            return list(new_chunks.items()), stale_ids
+        source = str(doc.metadata.get("source", ""))
+        chunks = {}
+        for split in self.text_splitter.split_documents([doc]):
+            chunks.setdefault(chunk_id(source, split.page_content), split)
+        return list(chunks.items()), []
+
+    async def _split(self, inp, out, seen_sources):
+        batch = []
+        while (doc := await inp.get()) is not _DONE:
+            seen_sources.add(str(doc.metadata.get("source", "")))
+            start = time.perf_counter()
+            chunks, stale_ids = self._split_one(doc)
+            self.counters["split"].add(len(chunks), time.perf_counter() - start)
+            if stale_ids:
+                await out.put(("delete", stale_ids))
+            for item in chunks:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    await out.put(("embed", batch))
+                    batch = []
+        if batch:
+            await out.put(("embed", batch))
+        await out.put(_DONE)
+
+    async def _embed(self, inp, out):
+        while (item := await inp.get()) is not _DONE:
+            kind, payload = item
+            if kind == "embed":
+                start = time.perf_counter()
+                # 嵌入是阻塞的网络调用，放到线程中执行，事件循环继续加载和切分后面的文档
+                vectors = await asyncio.to_thread(
+                    self.embeddings.embed_documents, [split.page_content for _, split in payload]
+                )
+                self.counters["embed"].add(len(payload), time.perf_counter() - start)
+                item = (kind, (payload, vectors))
+            await out.put(item)
+        await out.put(_DONE)
+
+    async def _write(self, inp):
+        while (item := await inp.get()) is not _DONE:
+            kind, payload = item
+            start = time.perf_counter()
+            if kind == "delete":
+                if self.delete is not None:
+                    await asyncio.to_thread(self.delete, payload)
+                continue
+            chunks, vectors = payload
+            await asyncio.to_thread(
+                self.upsert,
+                [_id for _id, _ in chunks],
+                [split.page_content for _, split in chunks],
+                [split.metadata for _, split in chunks],
+                vectors,
+            )
+            self.counters["upsert"].add(len(chunks), time.perf_counter() - start)
+
+    async def arun(self, documents, cleanup=False):
+        """
+        :param documents: 文档的同步或异步迭代器（例如 CachedWebLoader.alazy_load()）
+        :param cleanup: 配合 indexer 使用，为 True 时删除本次未出现的来源
+        :return: 各阶段的吞吐统计
+        """
+        loaded, split, embedded = (asyncio.Queue(maxsize=self.queue_size) for _ in range(3))
+        seen_sources = set()
+        # 任一阶段出错时 TaskGroup 会取消其余阶段，不会有阶段永远阻塞在队列上
+        async with asyncio.TaskGroup() as group:
+            group.create_task(self._load(documents, loaded))
+            group.create_task(self._split(loaded, split, seen_sources))
+            group.create_task(self._embed(split, embedded))
+            group.create_task(self._write(embedded))
+        if self.indexer is not None:
+            if cleanup:
+                stale_ids = self.indexer.remove_missing(seen_sources)
+                if stale_ids and self.delete is not None:
+                    self.delete(stale_ids)
+            self.indexer.save()
+        return self.stats()
+
+    def run(self, documents, cleanup=False):
+        return asyncio.run(self.arun(documents, cleanup=cleanup))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : semantic_cache.py
+语义答案缓存：以独立问题的向量为键，新问题与缓存问题的余弦相似度超过阈值、且索引版本未变时直接返回缓存的答案，
+省掉检索和生成两步。
+"""
+import threading
+
+import numpy as np
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
+
+
+class SemanticAnswerCache:
+    """
+    向量保存在一个预分配的归一化 float32 矩阵中，一次矩阵乘法完成查找；容量满时按 LRU 淘汰。
+    索引版本变化时整体失效。
+    """
+
+    def __init__(self, embeddings, threshold=0.92, max_entries=1000):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.index_version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._matrix = None
+        self._answers = [None] * max_entries
+        self._questions = [None] * max_entries
+        self._last_used = np.zeros(max_entries, dtype=np.int64)
+        self._size = 0
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def _embed(self, question):
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _check_version(self, index_version):
+        if index_version != self.index_version:
+            self.clear()
+            self.index_version = index_version
+
+    def clear(self):
+        with self._lock:
+            self._size = 0
+            self._answers = [None] * self.max_entries
+            self._questions = [None] * self.max_entries
+            self._last_used[:] = 0
+
+    def lookup(self, question, index_version=None):
+        """
+        返回 (命中的答案或 None, 问题向量)，向量可以直接传给 put，避免重复嵌入。
+        """
+        self._check_version(index_version)
+        vector = self._embed(question)
+        with self._lock:
+            self._clock += 1
+            if self._size:
+                scores = self._matrix[:self._size] @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self.hits += 1
+                    self._last_used[best] = self._clock
+                    return self._answers[best], vector
+            self.misses += 1
+        return None, vector
+
+    def put(self, question, answer, index_version=None, vector=None):
+        self._check_version(index_version)
+        if vector is None:
+            vector = self._embed(question)
+        with self._lock:
+            self._clock += 1
+            if self._matrix is None:
+                self._matrix = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+            if self._size < self.max_entries:
+                slot = self._size
+                self._size += 1
+            else:
+                slot = int(np.argmin(self._last_used))
+                self.evictions += 1
+            self._matrix[slot] = vector
+            self._questions[slot] = question
+            self._answers[slot] = answer
+            self._last_used[slot] = self._clock
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": self._size}
+
+
+def create_cached_retrieval_chain(standalone_question_chain, retriever, question_answer_chain, cache,
+                                  get_index_version=lambda: None):
+    """
+    与 create_retrieval_chain 相同的输入输出（{"input", "chat_history"} -> {..., "context", "answer"}）。
+    先得到独立问题并查询语义缓存；未命中时再检索和生成，生成结束后把答案写入缓存。保留流式输出。
+    """
+
+    def lookup(inputs):
+        answer, vector = cache.lookup(inputs["standalone_question"], get_index_version())
+        return {"answer": answer, "vector": vector}
+
+    def without_lookup(inputs):
+        # cache_lookup（含问题向量）只在链内部使用，不出现在输出和流式块中
+        return {key: value for key, value in inputs.items() if key != "cache_lookup"}
+
+    def remember(run):
+        outputs = run.outputs
+        cache.put(outputs["standalone_question"], outputs["answer"], get_index_version(),
+                  vector=run.inputs["cache_lookup"]["vector"])
+
+    generate = (
+        RunnableLambda(without_lookup)
+        | RunnablePassthrough.assign(context=(lambda x: x["standalone_question"]) | retriever)
+        .assign(answer=question_answer_chain)
+    ).with_listeners(on_end=remember)
+
+    def from_cache(inputs):
+        return {**without_lookup(inputs), "context": [], "answer": inputs["cache_lookup"]["answer"]}
+
+    def route(inputs):
+        return generate if inputs["cache_lookup"]["answer"] is None else RunnableLambda(from_cache)
+
+    return (
+        RunnablePassthrough.assign(standalone_question=standalone_question_chain)
+        .assign(cache_lookup=lookup)
+        | RunnableLambda(route)
+    ).with_config(run_name="cached_retrieval_chain")
@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : tokens.py
+不依赖分词器的 token 数估算，用于历史窗口和上下文预算。
+"""
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算 token 数：中日韩字符按 1 个 token，其余字符按 4 个字符 1 个 token。
+    """
+    cjk = sum(1 for ch in text if "\u2e80" <= ch <= "\u9fff" or "\uac00" <= ch <= "\ud7af")
+    return cjk + (len(text) - cjk + 3) // 4
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : web_loader.py
+并发网页加载器：用有界连接池并发抓取多个 URL，原始响应体缓存在本地磁盘，再次加载时用 ETag / Last-Modified
+做条件请求（304 时直接用缓存）；离线模式只读缓存。HTML 解析（SoupStrainer）放在进程池中，与网络 I/O 重叠执行。
+"""
+import asyncio
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Iterator, List
+
+import httpx
+from bs4 import BeautifulSoup
+from langchain_core.document_loaders import BaseLoader
+from langchain_core.documents import Document
+
+
+def parse_html(url, body, encoding, bs_kwargs):
+    """
+    在子进程中执行：解析 HTML 并返回与 WebBaseLoader 一致的 Document。
+    """
+    soup = BeautifulSoup(body, "html.parser", from_encoding=encoding, **(bs_kwargs or {}))
+    metadata = {"source": url}
+    if title := soup.find("title"):
+        metadata["title"] = title.get_text()
+    if description := soup.find("meta", attrs={"name": "description"}):
+        metadata["description"] = description.get("content", "No description found.")
+    if html := soup.find("html"):
+        metadata["language"] = html.get("lang", "No language found.")
+    return Document(page_content=soup.get_text(), metadata=metadata)
+
+
+class CachedWebLoader(BaseLoader):
+    """
+    用法与 WebBaseLoader 相同：CachedWebLoader(web_paths=(...), bs_kwargs=dict(parse_only=SoupStrainer(...))).load()
+    """
+
+    def __init__(self, web_paths, bs_kwargs=None, cache_dir="./web_cache", max_connections=10, offline=False,
+                 timeout=30.0, parse_workers=None, headers=None):
+        self.web_paths = list(web_paths)
+        self.bs_kwargs = bs_kwargs
+        self.cache_dir = cache_dir
+        self.max_connections = max_connections
+        self.offline = offline
+        self.timeout = timeout
+        self.parse_workers = parse_workers
+        self.headers = headers or {"User-Agent": "Mozilla/5.0 (compatible; transfer-learn loader)"}
+        self.stats = {"fetched": 0, "not_modified": 0, "from_cache": 0, "failed": 0}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _cache_paths(self, url):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key + ".body"), os.path.join(self.cache_dir, key + ".json")
+
+    def _read_cache(self, url):
+        body_path, meta_path = self._cache_paths(url)
+        if not (os.path.exists(body_path) and os.path.exists(meta_path)):
+            return None, None
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        with open(body_path, "rb") as f:
+            return f.read(), meta
+
+    def _write_cache(self, url, body, meta):
+        body_path, meta_path = self._cache_paths(url)
+        for path, data, mode in ((body_path, body, "wb"), (meta_path, json.dumps(meta), "w")):
+            tmp_path = path + ".tmp"
+            with open(tmp_path, mode) as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+    def _cached(self, url, body, meta, reason):
+        """
+        网络不可用（离线模式或请求失败）时退回到缓存内容。
+        """
+        if body is None:
+            print(f"{reason}: {url} is not cached, skipped")
+            self.stats["failed"] += 1
+            return None, None
+        if not self.offline:
+            print(f"{reason}: using cached copy of {url}")
+        self.stats["from_cache"] += 1
+        return body, meta.get("encoding")
+
+    @staticmethod
+    def _conditional_headers(meta):
+        headers = {}
+        if meta:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def _handle_response(self, url, response, body, meta):
+        if response.status_code == 304 and body is not None:
+            self.stats["not_modified"] += 1
+            return body, meta.get("encoding")
+        if response.status_code != 200:
+            print(f"Failed to fetch {url}: HTTP {response.status_code}")
+            self.stats["failed"] += 1
+            return None, None
+
+        meta = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "encoding": response.charset_encoding,
+        }
+        self._write_cache(url, response.content, meta)
+        self.stats["fetched"] += 1
+        return response.content, meta["encoding"]
+
+    async def _fetch(self, client, url):
+        """
+        返回 (响应体, 编码)，失败时返回 (None, None)。
+        """
+        body, meta = self._read_cache(url)
+        if self.offline:
+            return self._cached(url, body, meta, "Offline mode")
+        try:
+            response = await client.get(url, headers=self._conditional_headers(meta))
+        except httpx.HTTPError as e:
+            return self._cached(url, body, meta, f"Failed to fetch ({e})")
+        return self._handle_response(url, response, body, meta)
+
+    def _fetch_sync(self, client, url):
+        """
+        _fetch 的同步版本，供 lazy_load 使用。
+        """
+        body, meta = self._read_cache(url)
+        if self.offline:
+            return self._cached(url, body, meta, "Offline mode")
+        try:
+            response = client.get(url, headers=self._conditional_headers(meta))
+        except httpx.HTTPError as e:
+            return self._cached(url, body, meta, f"Failed to fetch ({e})")
+        return self._handle_response(url, response, body, meta)
+
+    async def alazy_load(self) -> AsyncIterator[Document]:
+        """
+        按完成顺序逐个产出文档。同时在途（下载或解析中）的 URL 不超过 max_connections 个，
+        消费方处理得慢时不会再发起新的下载，内存占用与 URL 总数无关。
+        """
+        loop = asyncio.get_running_loop()
+        limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+        with ProcessPoolExecutor(max_workers=self.parse_workers) as pool:
+            async with httpx.AsyncClient(limits=limits, timeout=self.timeout, headers=self.headers,
+                                         follow_redirects=True) as client:
+
+                async def load_one(url):
+                    body, encoding = await self._fetch(client, url)
+                    if body is None:
+                        return None
+                    # 抓到一个就立刻交给进程池解析，其余 URL 的下载继续进行
+                    return await loop.run_in_executor(pool, parse_html, url, body, encoding, self.bs_kwargs)
+
+                urls = iter(self.web_paths)
+                pending = set()
+                try:
+                    while True:
+                        for url in urls:
+                            pending.add(asyncio.ensure_future(load_one(url)))
+                            if len(pending) >= self.max_connections:
+                                break
+                        if not pending:
+                            break
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            if (doc := task.result()) is not None:
+                                yield doc
+                finally:
+                    for task in pending:
+                        task.cancel()
+
+    async def aload(self) -> List[Document]:
+        """
+        与 WebBaseLoader 一致，按 web_paths 的顺序返回（alazy_load 是按完成顺序产出的）。
+        """
+        position = {url: i for i, url in reversed(list(enumerate(self.web_paths)))}
+        docs = [doc async for doc in self.alazy_load()]
+        return sorted(docs, key=lambda doc: position[doc.metadata["source"]])
+
+    def lazy_load(self) -> Iterator[Document]:
+        """
+        同步逐页抓取和解析，同一时间只持有一个页面，在已运行的事件循环中调用也没有问题；需要并发时用 load() 或 alazy_load()。
+        """
+        with httpx.Client(timeout=self.timeout, headers=self.headers, follow_redirects=True) as client:
+            for url in self.web_paths:
+                body, encoding = self._fetch_sync(client, url)
+                if body is not None:
+                    yield parse_html(url, body, encoding, self.bs_kwargs)
+
+    def load(self) -> List[Document]:
+        """
+        并发抓取全部页面，按 web_paths 的顺序返回；当前线程已有运行中的事件循环时（例如在协程中调用）退回到逐页的 lazy_load。
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.aload())
+        return list(self.lazy_load())
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : example_store.py
+few-shot 示例的向量库封装：示例 id 由 input 字段的哈希派生，同一个问题永远对应同一条记录，
+新增和修改都是按 id upsert；按元数据删除/修改时把过滤条件下推给 Chroma（where），不再把整个集合取回 Python 逐条比较。
+批量写入时先与库中已有的文本比对，只有 input/output 真正变化的示例才会重新嵌入，并且合并成一次嵌入请求。
+"""
+import hashlib
+
+# Chroma 单次写入的条数上限（默认约 5461），超过时分块写入
+WRITE_BATCH_SIZE = 5000
+
+
+def example_id(example, key_fields=("input",)):
+    key = "\x1f".join(str(example.get(field, "")) for field in key_fields)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def example_text(example, text_fields=("input", "output")):
+    # 与原来的写法一致：input 和 output 拼成一段文本参与嵌入；其他元数据字段不影响向量
+    return " ".join(str(example[field]) for field in text_fields if field in example)
+
+
+def to_where(metadata):
+    """
+    {"input": "...", "output": "..."} -> Chroma 的 where 表达式（多个字段需要用 $and 组合）。
+    """
+    clauses = [{key: value} for key, value in metadata.items()]
+    if not clauses:
+        raise ValueError("Metadata filter must not be empty")
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+class ExampleStore:
+    """
+    :param vectorstore: langchain 的 Chroma 实例
+    :param key_fields: 决定示例身份的字段，默认只有 input：修改 output 时 id 不变，直接覆盖
+    """
+
+    def __init__(self, vectorstore, key_fields=("input",)):
+        self.vectorstore = vectorstore
+        self.key_fields = key_fields
+
+    @property
+    def collection(self):
+        return self.vectorstore._collection
+
+    def example_id(self, example):
+        return example_id(example, self.key_fields)
+
+    def _existing(self, ids):
+        """
+        按 id 取回已存储的 {id: (文本, 元数据)}，代价只与 ids 的数量有关。
+        """
+        existing = {}
+        for start in range(0, len(ids), WRITE_BATCH_SIZE):
+            result = self.collection.get(ids=ids[start:start + WRITE_BATCH_SIZE],
+                                         include=["documents", "metadatas"])
+            existing.update(zip(result["ids"], zip(result["documents"], result["metadatas"])))
+        return existing
+
+    def upsert_examples(self, examples):
+        """
+        批量新增或修改示例：
+        文本（input/output）变化或新出现的示例一次性嵌入、一次性写入；
+        文本没变、只有其他元数据变化的示例只更新元数据，不重新嵌入；完全相同的跳过。
+        返回各类的条数。
+        """
+        # 同一批中 id 重复时保留最后一条，Chroma 不允许一次 upsert 中出现重复 id
+        by_id = {self.example_id(example): example for example in examples}
+        existing = self._existing(list(by_id))
+        changed, metadata_only = [], []
+        for _id, example in by_id.items():
+            stored = existing.get(_id)
+            if stored is None or stored[0] != example_text(example):
+                changed.append(_id)
+            elif stored[1] != example:
+                metadata_only.append(_id)
+
+        if changed:
+            texts = [example_text(by_id[_id]) for _id in changed]
+            vectors = self.vectorstore.embeddings.embed_documents(texts)
+            for start in range(0, len(changed), WRITE_BATCH_SIZE):
+                end = start + WRITE_BATCH_SIZE
+                self.collection.upsert(ids=changed[start:end], embeddings=vectors[start:end],
+                                       documents=texts[start:end],
+                                       metadatas=[by_id[_id] for _id in changed[start:end]])
+        for start in range(0, len(metadata_only), WRITE_BATCH_SIZE):
+            chunk = metadata_only[start:start + WRITE_BATCH_SIZE]
+            self.collection.update(ids=chunk, metadatas=[by_id[_id] for _id in chunk])
+        return {"embedded": len(changed), "metadata_only": len(metadata_only),
+                "unchanged": len(by_id) - len(changed) - len(metadata_only)}
+
+    def upsert(self, examples):
+        """
+        新增或覆盖示例，返回它们的 id。
+        """
+        examples = list(examples)
+        self.upsert_examples(examples)
+        return list(dict.fromkeys(self.example_id(example) for example in examples))
+
+    def delete_examples(self, examples):
+        """
+        按示例（或直接按 id）批量删除，返回删除请求中的 id 数。
+        """
+        ids = list(dict.fromkeys(
+            self.example_id(example) if isinstance(example, dict) else example for example in examples
+        ))
+        for start in range(0, len(ids), WRITE_BATCH_SIZE):
+            self.collection.delete(ids=ids[start:start + WRITE_BATCH_SIZE])
+        return len(ids)
+
+    def sync_examples(self, examples):
+        """
+        让集合与给定的完整示例目录一致：upsert_examples 之后删除目录中已不存在的示例。
+        """
+        examples = list(examples)
+        stats = self.upsert_examples(examples)
+        wanted = {self.example_id(example) for example in examples}
+        stored = self.collection.get(include=[])["ids"]
+        stats["deleted"] = self.delete_examples([_id for _id in stored if _id not in wanted])
+        return stats
+
+    def find(self, where):
+        """
+        返回 (ids, metadatas)。只取元数据，不取向量和文本。
+        """
+        result = self.collection.get(where=to_where(where), include=["metadatas"])
+        return result["ids"], result["metadatas"]
+
+    def delete(self, where=None, ids=None):
+        """
+        按 id 或元数据条件删除；条件在 Chroma 内部求值。
+        """
+        if ids:
+            self.collection.delete(ids=list(ids))
+        if where:
+            self.collection.delete(where=to_where(where))
+
+    def update(self, where, changes):
+        """
+        把匹配 where 的示例的字段改成 changes。身份字段变化时 id 随之变化，旧记录会被删除。
+        """
+        ids, metadatas = self.find(where)
+        updated = [{**metadata, **changes} for metadata in metadatas]
+        new_ids = self.upsert(updated)
+        stale = set(ids) - set(new_ids)
+        if stale:
+            self.collection.delete(ids=list(stale))
+        return new_ids
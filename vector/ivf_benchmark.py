@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : ivf_benchmark.py
+IVF 索引基准：同一份合成语料上对比暴力检索和不同 nprobe 下的 recall@k 与单次查询延迟，
+用于挑选满足召回要求的最小 nprobe。
+
+运行：python -m vector.ivf_benchmark
+"""
+import time
+
+import numpy as np
+
+from vector.numpy_store import NumpyVectorStore, top_k
+from vector.quantization_benchmark import K, NUM_QUERIES, NUM_VECTORS, make_corpus
+
+NPROBES = (1, 2, 4, 8, 16, 32, 64)
+
+
+def measure(store, queries, truth):
+    start = time.perf_counter()
+    hits = [store._search(query[None, :], K)[0] for query in queries]
+    latency = (time.perf_counter() - start) / len(queries)
+    recall = np.mean([
+        len({row for row, _ in query_hits} & set(truth[i].tolist())) / K
+        for i, query_hits in enumerate(hits)
+    ])
+    return round(float(recall), 4), round(latency * 1000, 2)
+
+
+if __name__ == '__main__':
+    vectors, queries = make_corpus(np.random.default_rng(0))
+    truth = top_k(queries @ vectors.T, K)
+    store = NumpyVectorStore(None, capacity=len(vectors))
+    store.add_vectors([str(i) for i in range(len(vectors))], [""] * len(vectors), [{}] * len(vectors), vectors)
+    print(f"{NUM_VECTORS} vectors, {NUM_QUERIES} queries, recall@{K}")
+    print(f"{'index':<8} {'nprobe':>6} {'recall':>7} {'ms/query':>9}")
+    recall, latency = measure(store, queries, truth)
+    print(f"{'flat':<8} {'-':>6} {recall:>7} {latency:>9}")
+
+    start = time.perf_counter()
+    store.build_index()
+    print(f"trained {store._ivf.nlist} lists in {time.perf_counter() - start:.1f}s")
+    for nprobe in NPROBES:
+        store.nprobe = nprobe
+        recall, latency = measure(store, queries, truth)
+        print(f"{'ivf':<8} {nprobe:>6} {recall:>7} {latency:>9}")
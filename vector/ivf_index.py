@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : ivf_index.py
+IVF（倒排文件）近似最近邻索引：用球面 k-means 把向量划分成 nlist 个簇，查询时只扫描与查询最相近的 nprobe 个簇。
+nprobe 越大召回越高、延迟越大。训练后新增的向量直接分配到最近的簇，不需要重新训练。
+"""
+import numpy as np
+
+
+def kmeans(vectors, nlist, iterations=10, seed=0):
+    """
+    球面 k-means：按内积分配，簇中心取均值后重新归一化；空簇用随机样本重新初始化。
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        labels = assign(vectors, centroids)
+        # 按簇编号排序后用 reduceat 分段求和，比 np.add.at 快一个数量级
+        order = np.argsort(labels, kind="stable")
+        counts = np.bincount(labels, minlength=nlist)
+        sums = np.zeros_like(centroids)
+        nonempty = counts > 0
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+        sums[nonempty] = np.add.reduceat(vectors[order], starts, axis=0)
+        empty = counts == 0
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = sums / np.maximum(norms, 1e-12)
+    return centroids
+
+
+def assign(vectors, centroids, block_size=65536):
+    """
+    返回每个向量最近的簇编号，分块计算避免生成 (n, nlist) 的整张分数矩阵。
+    """
+    labels = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), block_size):
+        labels[start:start + block_size] = np.argmax(vectors[start:start + block_size] @ centroids.T, axis=1)
+    return labels
+
+
+class IVFIndex:
+    """
+    倒排表保存的是 NumpyVectorStore 矩阵中的行号。store 删除时把最后一行移到被删除的位置，
+    对应地调用 remove / move，两者都是 O(1)。
+    """
+
+    def __init__(self, centroids):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        nlist = len(self.centroids)
+        self.assignments = np.full(0, -1, dtype=np.int32)  # 行号 -> 簇编号，-1 表示未分配
+        self.positions = np.zeros(0, dtype=np.int64)  # 行号 -> 在所属倒排表中的位置
+        self._lists = [np.empty(16, dtype=np.int64) for _ in range(nlist)]
+        self._counts = np.zeros(nlist, dtype=np.int64)
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def train(cls, vectors, nlist, iterations=10, sample_size=None, seed=0):
+        """
+        只在采样上训练（默认每个簇 64 个样本），训练耗时只取决于 nlist，与向量总数无关。
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        nlist = min(nlist, len(vectors))
+        sample_size = sample_size or nlist * 64
+        if len(vectors) > sample_size:
+            sample = vectors[np.random.default_rng(seed).choice(len(vectors), sample_size, replace=False)]
+        else:
+            sample = vectors
+        return cls(kmeans(sample, nlist, iterations, seed))
+
+    def _grow(self, size):
+        if size > len(self.assignments):
+            capacity = max(size, len(self.assignments) * 2)
+            assignments = np.full(capacity, -1, dtype=np.int32)
+            assignments[:len(self.assignments)] = self.assignments
+            positions = np.zeros(capacity, dtype=np.int64)
+            positions[:len(self.positions)] = self.positions
+            self.assignments, self.positions = assignments, positions
+
+    def _append(self, cluster, row):
+        count = self._counts[cluster]
+        if count == len(self._lists[cluster]):
+            grown = np.empty(count * 2, dtype=np.int64)
+            grown[:count] = self._lists[cluster]
+            self._lists[cluster] = grown
+        self._lists[cluster][count] = row
+        self._counts[cluster] = count + 1
+        self.assignments[row] = cluster
+        self.positions[row] = count
+
+    def add(self, rows, vectors):
+        """
+        把归一化后的向量分配到最近的簇；行号已存在（覆盖写入）时先从原来的簇中移除。
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if not len(rows):
+            return
+        self._grow(int(rows.max()) + 1)
+        for row, cluster in zip(rows, assign(np.asarray(vectors, dtype=np.float32), self.centroids)):
+            if self.assignments[row] >= 0:
+                self.remove(row)
+            self._append(cluster, row)
+
+    def remove(self, row):
+        cluster = self.assignments[row]
+        if cluster < 0:
+            return
+        position = self.positions[row]
+        last = self._counts[cluster] - 1
+        moved = self._lists[cluster][last]
+        self._lists[cluster][position] = moved
+        self.positions[moved] = position
+        self._counts[cluster] = last
+        self.assignments[row] = -1
+
+    def move(self, src, dst):
+        """
+        行 src 的向量被搬到行 dst（dst 必须已经 remove）。
+        """
+        cluster = self.assignments[src]
+        if cluster < 0:
+            return
+        position = self.positions[src]
+        self._lists[cluster][position] = dst
+        self.assignments[dst] = cluster
+        self.positions[dst] = position
+        self.assignments[src] = -1
+
+    def probe(self, query, nprobe):
+        """
+        返回与查询最相近的 nprobe 个簇中的全部行号。
+        """
+        scores = self.centroids @ query
+        nprobe = min(nprobe, self.nlist)
+        clusters = np.argpartition(-scores, nprobe - 1)[:nprobe]
+        return np.concatenate([self._lists[c][:self._counts[c]] for c in clusters])
+
+    def list_sizes(self):
+        return self._counts.copy()
+
+    def save(self, path, size):
+        np.savez(path, centroids=self.centroids, assignments=self.assignments[:size])
+
+    @classmethod
+    def load(cls, path):
+        """
+        只保存了簇中心和每行的簇编号，倒排表在加载时按簇编号排序重建。
+        """
+        with np.load(path) as state:
+            index = cls(state["centroids"])
+            assignments = state["assignments"]
+        index._grow(len(assignments))
+        order = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments[assignments >= 0], minlength=index.nlist)
+        start = int(np.count_nonzero(assignments < 0))
+        for cluster, count in enumerate(counts):
+            rows = order[start:start + count]
+            index._lists[cluster] = np.concatenate([rows, np.empty(max(16, count), dtype=np.int64)])
+            index._counts[cluster] = count
+            index.assignments[rows] = cluster
+            index.positions[rows] = np.arange(count)
+            start += count
+        return index
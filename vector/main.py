@@ -4,15 +4,134 @@
 @Time    : 2025/12/31 18:11
 @Author  : chewl1
 @File    : main.py
+Milvus Lite 集合管理：集合和索引只在缺失时创建（重启后直接复用已有数据），
+按租户/来源划分分区，向量从 .npy / Parquet 文件分批导入。
 """
-from pymilvus import MilvusClient
+import os
+
+import numpy as np
+from pymilvus import DataType, MilvusClient
+
+INDEX_PARAMS = {
+    # M：每个节点的邻居数；efConstruction：建图时的候选数
+    "HNSW": {"M": 16, "efConstruction": 200},
+    # nlist：聚类中心数，一般取 4 * sqrt(向量数)
+    "IVF_FLAT": {"nlist": 1024},
+}
+
+
+class MilvusCollectionManager:
+    """
+    :param client: MilvusClient，Milvus Lite 传本地 .db 路径，也可以是 Milvus 服务的 URI
+    :param index_type: "HNSW" 或 "IVF_FLAT"；Milvus Lite 不支持的索引类型会按 FLAT 处理，
+        同样的配置连接 Milvus 服务端时生效
+    :param metric_type: "COSINE"、"IP" 或 "L2"
+    """
+
+    def __init__(self, client, collection_name, dimension, index_type="HNSW", metric_type="COSINE",
+                 index_params=None, max_text_length=8192):
+        self.client = client
+        self.collection_name = collection_name
+        self.dimension = dimension
+        self.index_type = index_type
+        self.metric_type = metric_type
+        self.index_params = index_params or INDEX_PARAMS.get(index_type, {})
+        self.max_text_length = max_text_length
+
+    def _schema(self):
+        schema = MilvusClient.create_schema(auto_id=False, enable_dynamic_field=True)
+        schema.add_field("id", DataType.INT64, is_primary=True)
+        schema.add_field("vector", DataType.FLOAT_VECTOR, dim=self.dimension)
+        schema.add_field("text", DataType.VARCHAR, max_length=self.max_text_length)
+        return schema
+
+    def _index(self):
+        index_params = self.client.prepare_index_params()
+        index_params.add_index(field_name="vector", index_type=self.index_type, metric_type=self.metric_type,
+                               params=self.index_params)
+        return index_params
+
+    def ensure(self):
+        """
+        幂等：集合不存在时按 schema 和索引配置创建；已存在时只校验维度、补建缺失的索引并加载。
+        返回 True 表示本次新建了集合。
+        """
+        if not self.client.has_collection(self.collection_name):
+            self.client.create_collection(self.collection_name, schema=self._schema(), index_params=self._index())
+            return True
+        fields = self.client.describe_collection(self.collection_name)["fields"]
+        vector_field = next(field for field in fields if field["name"] == "vector")
+        dimension = vector_field.get("params", {}).get("dim")
+        if dimension is not None and int(dimension) != self.dimension:
+            raise ValueError(f"Collection {self.collection_name!r} has dimension {dimension}, "
+                             f"expected {self.dimension}")
+        if not self.client.list_indexes(self.collection_name, field_name="vector"):
+            self.client.create_index(self.collection_name, self._index())
+        self.client.load_collection(self.collection_name)
+        return False
+
+    def ensure_partition(self, partition_name):
+        if not self.client.has_partition(self.collection_name, partition_name):
+            self.client.create_partition(self.collection_name, partition_name)
+        return partition_name
+
+    def _insert(self, ids, vectors, texts, partition_name):
+        rows = [
+            {"id": int(_id), "vector": vector, "text": text}
+            for _id, vector, text in zip(ids, np.asarray(vectors, dtype=np.float32).tolist(), texts)
+        ]
+        self.client.insert(self.collection_name, rows, partition_name=partition_name)
+
+    def bulk_load(self, path, partition_name=None, batch_size=10000, start_id=0, texts=None):
+        """
+        从 .npy（(n, dimension) 矩阵，以 memmap 打开）或 Parquet（列：id、vector，可选 text）分批导入。
+        .npy 没有 id 列时 id 为 start_id 起的连续整数。返回导入的条数。
+        """
+        if partition_name is not None:
+            self.ensure_partition(partition_name)
+        if path.endswith(".npy"):
+            return self._load_npy(path, partition_name, batch_size, start_id, texts)
+        if path.endswith(".parquet"):
+            return self._load_parquet(path, partition_name, batch_size)
+        raise ValueError(f"Unsupported file type: {path}")
+
+    def _load_npy(self, path, partition_name, batch_size, start_id, texts):
+        vectors = np.load(path, mmap_mode="r")
+        if vectors.ndim != 2 or vectors.shape[1] != self.dimension:
+            raise ValueError(f"{path} has shape {vectors.shape}, expected (n, {self.dimension})")
+        for start in range(0, len(vectors), batch_size):
+            end = min(start + batch_size, len(vectors))
+            batch_texts = texts[start:end] if texts is not None else [""] * (end - start)
+            self._insert(range(start_id + start, start_id + end), vectors[start:end], batch_texts, partition_name)
+        return len(vectors)
+
+    def _load_parquet(self, path, partition_name, batch_size):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path)
+        columns = [name for name in ("id", "vector", "text") if name in parquet_file.schema_arrow.names]
+        total = 0
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+            data = batch.to_pydict()
+            texts = data.get("text") or [""] * batch.num_rows
+            self._insert(data["id"], data["vector"], texts, partition_name)
+            total += batch.num_rows
+        return total
+
+    def count(self):
+        return self.client.get_collection_stats(self.collection_name)["row_count"]
+
 
 if __name__ == '__main__':
     client = MilvusClient("milvus_demo.db")
 
-    if client.has_collection(collection_name="demo_collection"):
-        client.drop_collection(collection_name="demo_collection")
-    client.create_collection(
-        collection_name="demo_collection",
-        dimension=768,  # The vectors we will use in this demo has 768 dimensions
-    )
+    # The vectors we will use in this demo has 768 dimensions
+    manager = MilvusCollectionManager(client, "demo_collection", dimension=768)
+    created = manager.ensure()
+    print("Created collection" if created else "Reusing existing collection", "- rows:", manager.count())
+
+    # 只在首次建库时导入，重启时直接复用已有数据
+    demo_vectors = "demo_vectors.npy"
+    if created and os.path.exists(demo_vectors):
+        loaded = manager.bulk_load(demo_vectors, partition_name="demo")
+        print(f"Loaded {loaded} vectors into partition 'demo'")
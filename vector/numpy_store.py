@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : numpy_store.py
+基于 NumPy 的内存向量库，可以替代 Chroma 作为 LangChain VectorStore 使用。
+向量归一化后按行存放在一个连续的 float32 矩阵中：单次查询是一次矩阵-向量乘法加 argpartition，
+批量查询是一次矩阵乘法（GEMM）。持久化使用 np.save，加载时以 memmap 方式打开，百万级向量也能毫秒级打开。
+可选 float16 / int8 量化：内存中只保留压缩后的向量用于找候选，候选再用 memmap 中的全精度向量精排；
+开启量化后全精度向量始终放在磁盘上可追加的 memmap 文件中，不会复制进内存。
+可选 IVF 近似索引（build_index）：查询只扫描最相近的 nprobe 个簇，代价不再随总量线性增长。
+"""
+import json
+import os
+import tempfile
+import uuid
+import weakref
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from vector.ivf_index import IVFIndex
+from vector.quantization import ScalarQuantizer
+
+VECTORS_FILE = "vectors.npy"
+RECORDS_FILE = "records.jsonl"
+OFFSETS_FILE = "offsets.npy"
+CODES_FILE = "codes.npy"
+QUANTIZER_FILE = "quantizer.npz"
+IVF_FILE = "ivf.npz"
+# 分块复制 memmap 时每块的行数
+COPY_BLOCK_ROWS = 65536
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def top_k(scores, k):
+    """
+    返回分数最高的 k 个下标（降序）。先用 argpartition 取出前 k 个，再只对这 k 个排序。
+    """
+    k = min(k, scores.shape[-1])
+    if k <= 0:
+        return np.empty(scores.shape[:-1] + (0,), dtype=np.int64)
+    if k < scores.shape[-1]:
+        idx = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    else:
+        idx = np.broadcast_to(np.arange(scores.shape[-1]), scores.shape).copy()
+    order = np.argsort(-np.take_along_axis(scores, idx, axis=-1), axis=-1)
+    return np.take_along_axis(idx, order, axis=-1)
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _replace_file(path, name, write):
+    tmp_path = os.path.join(path, name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, os.path.join(path, name))
+
+
+class _RecordFile:
+    """
+    按行存放 (id, text, metadata) 的 jsonl 文件，配合偏移量数组按需读取，打开时不加载全部内容。
+    """
+
+    def __init__(self, path, offsets):
+        self._file = open(path, "rb")
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, row):
+        self._file.seek(int(self._offsets[row]))
+        return tuple(json.loads(self._file.readline()))
+
+    def ids(self):
+        """
+        顺序扫描一遍文件，只保留每行的 id。
+        """
+        self._file.seek(0)
+        return [json.loads(line)[0] for line in self._file]
+
+    def close(self):
+        self._file.close()
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    用法与 Chroma 相同：NumpyVectorStore(embedding).add_texts(...)、as_retriever()、similarity_search(...)。
+    删除时把最后一行移到被删除的位置，矩阵始终保持连续。
+
+    :param quantization: None、"float16" 或 "int8"。开启后在压缩向量上取 k * rescore_factor 个候选，
+        再用全精度向量精排出前 k 个
+    :param nprobe: 调用 build_index 之后，每次查询扫描的簇数，越大召回越高、延迟越大
+    :param spill_dir: 量化时全精度向量工作文件所在的目录，默认系统临时目录
+    """
+
+    def __init__(self, embedding: Embeddings, capacity: int = 1024, quantization: Optional[str] = None,
+                 rescore_factor: int = 4, nprobe: int = 8, spill_dir: Optional[str] = None):
+        self.embedding = embedding
+        self.rescore_factor = rescore_factor
+        self.nprobe = nprobe
+        self.spill_dir = spill_dir
+        self._spill_path = None  # 量化时全精度向量的工作文件（无文件头的 float32 行）
+        self._spilled = False  # self._vectors 是否为可写的工作文件 memmap
+        self._ivf = None
+        self._quantizer = ScalarQuantizer(quantization) if quantization else None
+        self._codes = None
+        self._vectors = None
+        self._capacity = capacity
+        self._size = 0
+        self._records = []  # [(id, text, metadata)]，与矩阵的行一一对应
+        self._id_to_row = {}
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding
+
+    def __len__(self):
+        return self._size
+
+    def memory_usage(self):
+        """
+        常驻内存中的向量字节数（memmap 的全精度向量不计入）。
+        """
+        total = 0 if self._codes is None else self._codes[:self._size].nbytes
+        if self._vectors is not None and not isinstance(self._vectors, np.memmap):
+            total += self._vectors[:self._size].nbytes
+        return total
+
+    # -------- 写入 --------
+    def _materialize(self):
+        """
+        从磁盘 memmap 打开的索引在第一次修改前复制到内存中。
+        """
+        if isinstance(self._records, _RecordFile):
+            record_file = self._records
+            self._records = [record_file[row] for row in range(len(record_file))]
+            record_file.close()
+        self._ensure_id_map()
+        if isinstance(self._vectors, np.memmap) and not self._spilled:
+            if self._quantizer is not None:
+                self._spill(self._size, self._vectors.shape[1])
+            else:
+                self._vectors = np.array(self._vectors[:self._size])
+                self._capacity = self._size
+
+    def _ensure_id_map(self):
+        """
+        id -> 行号的映射在第一次按 id 访问时才建立；只读访问不会复制向量和文本。
+        """
+        if self._id_to_row is None:
+            ids = self._records.ids() if isinstance(self._records, _RecordFile) else [r[0] for r in self._records]
+            self._id_to_row = {_id: row for row, _id in enumerate(ids)}
+
+    def _spill(self, capacity, dim):
+        """
+        把全精度向量放到（或扩容）磁盘上的工作文件并重新映射。扩容只是截断文件到更大长度，
+        首次从内存数组或只读 memmap 转入时分块复制，任何时候都不会在内存中生成整张矩阵。
+        """
+        if self._spill_path is None:
+            fd, self._spill_path = tempfile.mkstemp(prefix="numpy_store_", suffix=".f32", dir=self.spill_dir)
+            os.close(fd)
+            weakref.finalize(self, _remove_file, self._spill_path)
+        old = None if self._spilled else self._vectors
+        with open(self._spill_path, "r+b") as f:
+            f.truncate(capacity * dim * np.dtype(np.float32).itemsize)
+        vectors = np.memmap(self._spill_path, dtype=np.float32, mode="r+", shape=(capacity, dim))
+        if old is not None:
+            for start in range(0, self._size, COPY_BLOCK_ROWS):
+                end = min(start + COPY_BLOCK_ROWS, self._size)
+                vectors[start:end] = old[start:end]
+        self._vectors = vectors
+        self._spilled = True
+        self._capacity = capacity
+
+    def _reserve(self, dim, extra):
+        if self._quantizer is not None:
+            needed = self._size + extra
+            if self._vectors is None:
+                self._spill(max(self._capacity, needed), dim)
+            elif needed > self._vectors.shape[0]:
+                self._spill(max(needed, self._vectors.shape[0] * 2), dim)
+        elif self._vectors is None:
+            self._capacity = max(self._capacity, extra)
+            self._vectors = np.zeros((self._capacity, dim), dtype=np.float32)
+        else:
+            needed = self._size + extra
+            if needed > self._vectors.shape[0]:
+                capacity = max(needed, self._vectors.shape[0] * 2)
+                grown = np.zeros((capacity, self._vectors.shape[1]), dtype=np.float32)
+                grown[:self._size] = self._vectors[:self._size]
+                self._vectors = grown
+                self._capacity = capacity
+        if self._quantizer is not None and (self._codes is None or self._codes.shape[0] < self._capacity):
+            codes = np.zeros((self._capacity, dim), dtype=self._quantizer.dtype)
+            if self._codes is not None:
+                codes[:self._size] = self._codes[:self._size]
+            self._codes = codes
+
+    def add_vectors(self, ids, texts, metadatas, vectors):
+        """
+        写入已经算好的向量（id 已存在时覆盖），签名与 IngestPipeline 的 upsert 一致。
+        """
+        vectors = normalize(vectors)
+        if vectors.ndim != 2 or not len(vectors):
+            return []
+        self._materialize()
+        self._reserve(vectors.shape[1], len(vectors))
+        if self._quantizer is not None:
+            if not self._quantizer.trained:
+                # int8 的逐维范围用第一批数据拟合，之后超出范围的值会被截断，可调用 requantize() 重新拟合
+                self._quantizer.fit(vectors)
+            codes = self._quantizer.encode(vectors)
+        rows = []
+        for i, (_id, text, metadata, vector) in enumerate(zip(ids, texts, metadatas, vectors)):
+            row = self._id_to_row.get(_id)
+            if row is None:
+                row = self._size
+                self._size += 1
+                self._records.append(None)
+                self._id_to_row[_id] = row
+            self._vectors[row] = vector
+            if self._quantizer is not None:
+                self._codes[row] = codes[i]
+            self._records[row] = (_id, text, metadata or {})
+            rows.append(row)
+        if self._ivf is not None:
+            # 新向量直接分到最近的簇，不重新训练；分布明显变化后可再次调用 build_index
+            self._ivf.add(rows, vectors[:len(rows)])
+        return list(ids)
+
+    def build_index(self, nlist: Optional[int] = None, iterations: int = 10, sample_size: Optional[int] = None):
+        """
+        在当前全部向量上训练 IVF 索引，nlist 默认取 4 * sqrt(n)。
+        """
+        if not self._size:
+            return
+        vectors = self._vectors[:self._size]
+        nlist = nlist or max(1, int(4 * np.sqrt(self._size)))
+        self._ivf = IVFIndex.train(vectors, nlist, iterations=iterations, sample_size=sample_size)
+        self._ivf.add(np.arange(self._size), vectors)
+
+    def requantize(self):
+        """
+        用当前全部向量重新拟合量化参数并重新编码。
+        """
+        if self._quantizer is None or not self._size:
+            return
+        blocks = [(start, min(start + COPY_BLOCK_ROWS, self._size)) for start in range(0, self._size, COPY_BLOCK_ROWS)]
+        # 量化参数只取决于逐维最小/最大值：用各块的最小值和最大值拟合，结果与整体拟合相同
+        self._quantizer.fit(np.concatenate([
+            np.stack([self._vectors[start:end].min(axis=0), self._vectors[start:end].max(axis=0)])
+            for start, end in blocks
+        ]))
+        self._codes = np.zeros((self._capacity, self._vectors.shape[1]), dtype=self._quantizer.dtype)
+        for start, end in blocks:
+            self._codes[start:end] = self._quantizer.encode(np.asarray(self._vectors[start:end]))
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                  ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        ids = list(ids) if ids else [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        return self.add_vectors(ids, texts, metadatas, self.embedding.embed_documents(texts))
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        if not ids:
+            return False
+        self._materialize()
+        for _id in ids:
+            row = self._id_to_row.pop(_id, None)
+            if row is None:
+                continue
+            last = self._size - 1
+            if self._ivf is not None:
+                self._ivf.remove(row)
+                if row != last:
+                    self._ivf.move(last, row)
+            if row != last:
+                self._vectors[row] = self._vectors[last]
+                if self._codes is not None:
+                    self._codes[row] = self._codes[last]
+                self._records[row] = self._records[last]
+                self._id_to_row[self._records[row][0]] = row
+            self._records.pop()
+            self._size -= 1
+        return True
+
+    def get_by_ids(self, ids: Sequence[str], /) -> List[Document]:
+        self._ensure_id_map()
+        return [self._document(self._id_to_row[_id]) for _id in ids if _id in self._id_to_row]
+
+    # -------- 查询 --------
+    def _document(self, row):
+        _id, text, metadata = self._records[row]
+        return Document(page_content=text, metadata=metadata, id=_id)
+
+    def _filter_mask(self, filter):
+        if filter is None:
+            return None
+        match = filter if callable(filter) else (
+            lambda metadata: all(metadata.get(key) == value for key, value in filter.items())
+        )
+        return np.fromiter((match(self._records[row][2]) for row in range(self._size)), dtype=bool,
+                           count=self._size)
+
+    def _search(self, query_vectors, k, filter=None):
+        """
+        query_vectors 为 (m, d) 的归一化矩阵，返回每个查询的 [(行号, 分数)]。
+        """
+        if not self._size:
+            return [[] for _ in range(len(query_vectors))]
+        mask = self._filter_mask(filter)
+        if self._ivf is not None:
+            return [self._search_ivf(query, k, mask) for query in query_vectors]
+        if self._quantizer is not None:
+            return self._search_quantized(query_vectors, k, mask)
+        scores = query_vectors @ self._vectors[:self._size].T
+        if mask is not None:
+            scores[:, ~mask] = -np.inf
+        rows = top_k(scores, k)
+        return [
+            [(int(row), float(scores[i, row])) for row in rows[i] if np.isfinite(scores[i, row])]
+            for i in range(len(rows))
+        ]
+
+    def _rescore(self, query, rows, k):
+        rows = np.sort(rows)
+        # 只读取候选行的全精度向量（memmap 时按行号顺序读盘）
+        exact = np.asarray(self._vectors[rows]) @ query
+        return [(int(rows[j]), float(exact[j])) for j in top_k(exact, k)]
+
+    def _search_quantized(self, query_vectors, k, mask):
+        approx = self._quantizer.scores(self._codes[:self._size], query_vectors)
+        if mask is not None:
+            approx[:, ~mask] = -np.inf
+        candidates = top_k(approx, k * self.rescore_factor)
+        return [
+            self._rescore(query, candidates[i][np.isfinite(approx[i, candidates[i]])], k)
+            for i, query in enumerate(query_vectors)
+        ]
+
+    def _search_ivf(self, query, k, mask):
+        rows = self._ivf.probe(query, self.nprobe)
+        if mask is not None:
+            rows = rows[mask[rows]]
+        if self._quantizer is not None and len(rows) > k * self.rescore_factor:
+            approx = self._quantizer.scores(self._codes[rows], query[None, :])[0]
+            rows = rows[top_k(approx, k * self.rescore_factor)]
+        return self._rescore(query, rows, k)
+
+    def similarity_search_with_score_by_vector(self, embedding: List[float], k: int = 4,
+                                               filter=None) -> List[Tuple[Document, float]]:
+        hits = self._search(normalize([embedding]), k, filter)[0]
+        return [(self._document(row), score) for row, score in hits]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, filter=None,
+                                    **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k, filter)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter=None,
+                                     **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self.embedding.embed_query(query), k, filter)
+
+    def similarity_search(self, query: str, k: int = 4, filter=None, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def batch_similarity_search(self, queries: List[str], k: int = 4, filter=None) -> List[List[Document]]:
+        """
+        多个查询一起按查询类型嵌入（embedding 提供 embed_queries 时合并请求，否则逐条 embed_query），
+        再用一次矩阵乘法算出全部相似度。
+        """
+        if not queries:
+            return []
+        queries = list(queries)
+        if hasattr(self.embedding, "embed_queries"):
+            vectors = self.embedding.embed_queries(queries)
+        else:
+            vectors = [self.embedding.embed_query(query) for query in queries]
+        hits = self._search(normalize(vectors), k, filter)
+        return [[self._document(row) for row, _ in query_hits] for query_hits in hits]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # 分数已经是余弦相似度
+        return lambda score: score
+
+    # -------- 持久化 --------
+    def save(self, path):
+        """
+        向量写成 vectors.npy，文本和元数据写成 records.jsonl，每行的字节偏移写成 offsets.npy。
+        每个文件先写到同目录的临时文件再 os.replace 替换：保存到 load() 时的同一目录也是安全的，
+        当前 memmap 和打开的 records.jsonl 仍然指向旧文件，直到写完才切换。
+        """
+        os.makedirs(path, exist_ok=True)
+        vectors = (np.ascontiguousarray(self._vectors[:self._size])
+                   if self._vectors is not None else np.zeros((0, 0), dtype=np.float32))
+        _replace_file(path, VECTORS_FILE, lambda f: np.save(f, vectors))
+        offsets = np.zeros(self._size, dtype=np.int64)
+
+        def write_records(f):
+            for row in range(self._size):
+                offsets[row] = f.tell()
+                f.write(json.dumps(self._records[row], ensure_ascii=False).encode("utf-8") + b"\n")
+
+        _replace_file(path, RECORDS_FILE, write_records)
+        _replace_file(path, OFFSETS_FILE, lambda f: np.save(f, offsets))
+        if self._quantizer is not None:
+            codes = (np.ascontiguousarray(self._codes[:self._size])
+                     if self._codes is not None else np.zeros((0, 0), dtype=self._quantizer.dtype))
+            _replace_file(path, CODES_FILE, lambda f: np.save(f, codes))
+            _replace_file(path, QUANTIZER_FILE,
+                          lambda f: np.savez(f, kind=self._quantizer.kind, **self._quantizer.state()))
+        if self._ivf is not None:
+            _replace_file(path, IVF_FILE, lambda f: self._ivf.save(f, self._size))
+
+    @classmethod
+    def load(cls, path, embedding: Embeddings, rescore_factor: int = 4, nprobe: int = 8):
+        """
+        以 memmap 方式打开已保存的索引：向量和文本都不会被整体读入内存，第一次修改时才复制（开启量化时复制到磁盘工作文件而不是内存）。
+        量化索引的压缩向量会读入内存，全精度向量仍然是 memmap，只在精排时按行读取。
+        """
+        store = cls(embedding, rescore_factor=rescore_factor, nprobe=nprobe)
+        if os.path.exists(os.path.join(path, IVF_FILE)):
+            store._ivf = IVFIndex.load(os.path.join(path, IVF_FILE))
+        quantizer_path = os.path.join(path, QUANTIZER_FILE)
+        if os.path.exists(quantizer_path):
+            with np.load(quantizer_path) as state:
+                kind = str(state["kind"])
+                params = {key: state[key] for key in state.files if key != "kind"}
+            store._quantizer = ScalarQuantizer(kind, **params)
+            codes = np.load(os.path.join(path, CODES_FILE))
+            # 空索引保存的是 (0, 0) 的占位数组，第一次写入时再按维度分配
+            store._codes = codes if len(codes) else None
+        vectors = np.load(os.path.join(path, VECTORS_FILE), mmap_mode="r")
+        offsets = np.load(os.path.join(path, OFFSETS_FILE), mmap_mode="r")
+        store._size = len(offsets)
+        if store._size:
+            store._vectors = vectors
+            store._capacity = store._size
+        store._records = _RecordFile(os.path.join(path, RECORDS_FILE), offsets)
+        store._id_to_row = None
+        return store
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   ids: Optional[List[str]] = None, **kwargs: Any) -> "NumpyVectorStore":
+        store = cls(embedding, **kwargs)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : quantization.py
+向量标量量化：float16（每维 2 字节）和逐维 8 bit 量化（每维 1 字节，按每一维的最小/最大值线性映射到 0~255）。
+在压缩空间里算近似分数找候选，再用全精度向量精排。
+"""
+import numpy as np
+
+QUANTIZATION_KINDS = ("float16", "int8")
+
+
+class ScalarQuantizer:
+
+    def __init__(self, kind, offset=None, scale=None):
+        if kind not in QUANTIZATION_KINDS:
+            raise ValueError(f"Unsupported quantization {kind!r}, expected one of {QUANTIZATION_KINDS}")
+        self.kind = kind
+        self.offset = offset
+        self.scale = scale
+
+    @property
+    def dtype(self):
+        return np.float16 if self.kind == "float16" else np.uint8
+
+    @property
+    def trained(self):
+        return self.kind == "float16" or self.offset is not None
+
+    def fit(self, vectors):
+        if self.kind == "int8":
+            low = vectors.min(axis=0)
+            high = vectors.max(axis=0)
+            self.offset = low.astype(np.float32)
+            self.scale = np.maximum(high - low, 1e-12).astype(np.float32) / 255.0
+        return self
+
+    def encode(self, vectors):
+        if self.kind == "float16":
+            return vectors.astype(np.float16)
+        codes = np.rint((vectors - self.offset) / self.scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def decode(self, codes):
+        if self.kind == "float16":
+            return codes.astype(np.float32)
+        return codes.astype(np.float32) * self.scale + self.offset
+
+    def scores(self, codes, queries, block_size=2048):
+        """
+        queries 为 (m, d)，返回 (m, n) 的近似内积。按小块解码（块留在 CPU 缓存中），避免一次性生成整张 float32 矩阵。
+        int8 利用 q·(offset + scale*c) = (q*scale)·c + q·offset，不需要逐元素解码。
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        result = np.empty((len(queries), len(codes)), dtype=np.float32)
+        if self.kind == "float16":
+            weights, bias = queries.T, 0.0
+        else:
+            weights, bias = (queries * self.scale).T, queries @ self.offset
+        for start in range(0, len(codes), block_size):
+            block = codes[start:start + block_size].astype(np.float32)
+            result[:, start:start + block_size] = (block @ weights).T
+        if self.kind == "int8":
+            result += bias[:, None]
+        return result
+
+    def state(self):
+        # float16 没有参数；尚未拟合的 int8 也没有参数可保存，加载后用第一批数据拟合
+        if self.kind == "float16" or not self.trained:
+            return {}
+        return {"offset": self.offset, "scale": self.scale}
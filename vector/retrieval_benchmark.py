@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@File    : retrieval_benchmark.py
+检索基准：在 1 万 / 10 万 / 100 万条合成切片上对比 Chroma、Milvus Lite 和本地 NumpyVectorStore（暴力 / IVF / int8），
+测量写入吞吐、单次查询 p50/p99 延迟、相对精确检索的 recall@k、磁盘占用和常驻内存增量，结果写成 JSON 报告。
+全程离线：切片由固定随机种子生成，嵌入用确定性的哈希词向量（DeterministicEmbeddings），不调用任何 API。
+每个 (后端, 规模) 在独立子进程中运行，内存统计互不干扰。传入 --baseline 时与上一次报告对比，退化时返回非零退出码。
+
+运行：python -m vector.retrieval_benchmark --sizes 10000 100000 --output retrieval_benchmark.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from vector.numpy_store import NumpyVectorStore, normalize, top_k
+
+BACKENDS = ("numpy", "numpy-ivf", "numpy-int8", "chroma", "milvus-lite")
+SIZES = (10_000, 100_000, 1_000_000)
+DIM = 384
+VOCAB_SIZE = 20_000
+NUM_TOPICS = 200
+TOPIC_WORDS = 50
+DOC_WORDS = 30
+NUM_QUERIES = 200
+K = 10
+BATCH_SIZE = 5000
+SEED = 0
+
+
+class DeterministicEmbeddings(Embeddings):
+    """
+    每个词的向量由词本身的 sha256 决定，文本向量为词向量之和再归一化。
+    同一文本在任何机器上得到相同向量，共享词越多的文本越相似，足以检验检索的排序是否正确。
+    """
+
+    def __init__(self, dim=DIM):
+        self.dim = dim
+        self._word_ids = {}
+        self._word_vectors = np.zeros((0, dim), dtype=np.float32)
+
+    def _word_id(self, word, new_words):
+        word_id = self._word_ids.get(word)
+        if word_id is None:
+            word_id = self._word_ids[word] = len(self._word_ids)
+            seed = int.from_bytes(hashlib.sha256(word.encode("utf-8")).digest()[:8], "little")
+            new_words.append(np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32))
+        return word_id
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_array(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_array([text])[0].tolist()
+
+    def embed_array(self, texts, block_size=10000):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for begin in range(0, len(texts), block_size):
+            new_words = []
+            words = [[self._word_id(word, new_words) for word in text.split()]
+                     for text in texts[begin:begin + block_size]]
+            if new_words:
+                self._word_vectors = np.concatenate([self._word_vectors, np.stack(new_words)])
+            # 所有词的编号拼成一维数组，用 reduceat 按文本分段求和
+            lengths = np.fromiter((len(w) for w in words), dtype=np.int64, count=len(words))
+            flat = np.fromiter((i for w in words for i in w), dtype=np.int64, count=int(lengths.sum()))
+            nonempty = lengths > 0
+            if flat.size:
+                starts = (np.cumsum(lengths) - lengths)[nonempty]
+                block = vectors[begin:begin + len(words)]
+                block[nonempty] = np.add.reduceat(self._word_vectors[flat], starts, axis=0)
+        return normalize(vectors)
+
+
+def make_corpus(size, seed=SEED):
+    """
+    每个主题有自己的一组高频词，切片由所属主题的词和全局词混合而成；查询取某个主题的若干个词。
+    """
+    rng = np.random.default_rng(seed)
+    topic_vocab = rng.integers(0, VOCAB_SIZE, (NUM_TOPICS, TOPIC_WORDS))
+    topics = rng.integers(0, NUM_TOPICS, size)
+    topical = topic_vocab[topics[:, None], rng.integers(0, TOPIC_WORDS, (size, DOC_WORDS * 2 // 3))]
+    general = rng.integers(0, VOCAB_SIZE, (size, DOC_WORDS - topical.shape[1]))
+    words = np.concatenate([topical, general], axis=1)
+    texts = [" ".join(f"w{w}" for w in row) for row in words]
+    query_topics = rng.integers(0, NUM_TOPICS, NUM_QUERIES)
+    query_words = topic_vocab[query_topics[:, None], rng.integers(0, TOPIC_WORDS, (NUM_QUERIES, 6))]
+    queries = [" ".join(f"w{w}" for w in row) for row in query_words]
+    return texts, queries
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # 非 Linux 平台退回到峰值常驻内存（macOS 单位为字节，其他为 KB）
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def disk_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total
+
+
+# -------- 后端：ingest(ids, texts, vectors) / finish() / search(vector, k) -> [行号] --------
+class NumpyBackend:
+
+    def __init__(self, path, size, kind):
+        self.path = path
+        self.kind = kind
+        self.store = NumpyVectorStore(None, capacity=size, quantization="int8" if kind == "numpy-int8" else None)
+
+    def ingest(self, ids, texts, vectors):
+        self.store.add_vectors([str(i) for i in ids], texts, [{} for _ in ids], vectors)
+
+    def finish(self):
+        if self.kind == "numpy-ivf":
+            self.store.build_index()
+        self.store.save(self.path)
+
+    def search(self, vector, k):
+        return [row for row, _ in self.store._search(vector[None, :], k)[0]]
+
+
+class ChromaBackend:
+
+    def __init__(self, path, size, kind):
+        import chromadb
+
+        self.client = chromadb.PersistentClient(path=path)
+        self.collection = self.client.create_collection("benchmark", metadata={"hnsw:space": "cosine"})
+        self.max_batch = self.client.get_max_batch_size()
+
+    def ingest(self, ids, texts, vectors):
+        for start in range(0, len(ids), self.max_batch):
+            end = start + self.max_batch
+            self.collection.add(ids=[str(i) for i in ids[start:end]], documents=texts[start:end],
+                                embeddings=vectors[start:end])
+
+    def finish(self):
+        pass
+
+    def search(self, vector, k):
+        result = self.collection.query(query_embeddings=[vector], n_results=k, include=[])
+        return [int(i) for i in result["ids"][0]]
+
+
+class MilvusLiteBackend:
+
+    def __init__(self, path, size, kind):
+        from pymilvus import MilvusClient
+
+        os.makedirs(path, exist_ok=True)
+        self.client = MilvusClient(os.path.join(path, "milvus.db"))
+        self.client.create_collection("benchmark", dimension=DIM, metric_type="COSINE", auto_id=False)
+
+    def ingest(self, ids, texts, vectors):
+        self.client.insert("benchmark", [
+            {"id": int(i), "vector": vector.tolist(), "text": text} for i, text, vector in zip(ids, texts, vectors)
+        ])
+
+    def finish(self):
+        self.client.flush("benchmark")
+
+    def search(self, vector, k):
+        return [hit["id"] for hit in self.client.search("benchmark", data=[vector.tolist()], limit=k)[0]]
+
+
+BACKEND_CLASSES = {"numpy": NumpyBackend, "numpy-ivf": NumpyBackend, "numpy-int8": NumpyBackend,
+                   "chroma": ChromaBackend, "milvus-lite": MilvusLiteBackend}
+
+
+def run_backend(kind, size, data_dir):
+    """
+    在子进程中执行：读入预先算好的向量，写入后端、逐条查询，返回一行结果。
+    """
+    texts, _ = make_corpus(size)
+    vectors = np.load(os.path.join(data_dir, "corpus.npy"))
+    query_vectors = np.load(os.path.join(data_dir, "queries.npy"))
+    truth = np.load(os.path.join(data_dir, "truth.npy"))
+    result = {"backend": kind, "corpus_size": size}
+    index_dir = tempfile.mkdtemp(prefix=f"bench-{kind}-")
+    try:
+        baseline_rss = rss_bytes()
+        try:
+            backend = BACKEND_CLASSES[kind](index_dir, size, kind)
+        except ImportError as e:
+            result["error"] = f"skipped: {e}"
+            return result
+
+        start = time.perf_counter()
+        for begin in range(0, size, BATCH_SIZE):
+            end = min(begin + BATCH_SIZE, size)
+            backend.ingest(list(range(begin, end)), texts[begin:end], vectors[begin:end])
+        backend.finish()
+        ingest_seconds = time.perf_counter() - start
+
+        latencies, hits = [], []
+        for vector in query_vectors:
+            start = time.perf_counter()
+            hits.append(backend.search(vector, K))
+            latencies.append(time.perf_counter() - start)
+        recall = np.mean([len(set(h) & set(truth[i].tolist())) / K for i, h in enumerate(hits)])
+
+        result.update({
+            "ingest_seconds": round(ingest_seconds, 3),
+            "ingest_per_sec": round(size / ingest_seconds),
+            "p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 3),
+            "p99_ms": round(float(np.percentile(latencies, 99)) * 1000, 3),
+            f"recall_at_{K}": round(float(recall), 4),
+            "disk_mb": round(disk_bytes(index_dir) / 2 ** 20, 1),
+            "rss_mb": round((rss_bytes() - baseline_rss) / 2 ** 20, 1),
+        })
+        return result
+    finally:
+        shutil.rmtree(index_dir, ignore_errors=True)
+
+
+def prepare(size, data_dir):
+    """
+    嵌入语料和查询，用暴力检索算出真值。返回嵌入吞吐（条/秒）。
+    """
+    texts, queries = make_corpus(size)
+    embeddings = DeterministicEmbeddings()
+    start = time.perf_counter()
+    vectors = embeddings.embed_array(texts)
+    embed_seconds = time.perf_counter() - start
+    query_vectors = embeddings.embed_array(queries)
+    truth = np.concatenate([top_k(block @ vectors.T, K) for block in np.array_split(query_vectors, 10)])
+    np.save(os.path.join(data_dir, "corpus.npy"), vectors)
+    np.save(os.path.join(data_dir, "queries.npy"), query_vectors)
+    np.save(os.path.join(data_dir, "truth.npy"), truth)
+    return round(size / embed_seconds)
+
+
+def compare(report, baseline, tolerance):
+    """
+    与基线报告逐行对比：召回下降，或写入吞吐 / p99 延迟变差超过 tolerance 时视为退化。
+    """
+    previous = {(r["backend"], r["corpus_size"]): r for r in baseline["results"] if "error" not in r}
+    regressions = []
+    for r in report["results"]:
+        old = previous.get((r["backend"], r["corpus_size"]))
+        if old is None or "error" in r:
+            continue
+        name = f"{r['backend']}@{r['corpus_size']}"
+        recall_key = f"recall_at_{K}"
+        if r[recall_key] < old[recall_key] - 0.01:
+            regressions.append(f"{name}: {recall_key} {old[recall_key]} -> {r[recall_key]}")
+        if r["p99_ms"] > old["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99_ms {old['p99_ms']} -> {r['p99_ms']}")
+        if r["ingest_per_sec"] < old["ingest_per_sec"] * (1 - tolerance):
+            regressions.append(f"{name}: ingest_per_sec {old['ingest_per_sec']} -> {r['ingest_per_sec']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=BACKENDS)
+    parser.add_argument("--output", default="retrieval_benchmark.json")
+    parser.add_argument("--baseline", help="上一次的报告，用于检测退化")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    report = {
+        "config": {"dim": DIM, "k": K, "queries": NUM_QUERIES, "batch_size": BATCH_SIZE, "seed": SEED},
+        "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                        "machine": platform.machine(), "cpus": os.cpu_count()},
+        "embed_per_sec": {},
+        "results": [],
+    }
+    print(f"{'backend':<12} {'size':>8} {'ingest/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'recall':>7} "
+          f"{'disk MB':>8} {'rss MB':>8}")
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as data_dir:
+            report["embed_per_sec"][str(size)] = prepare(size, data_dir)
+            for kind in args.backends:
+                with ProcessPoolExecutor(max_workers=1) as pool:
+                    r = pool.submit(run_backend, kind, size, data_dir).result()
+                report["results"].append(r)
+                if "error" in r:
+                    print(f"{kind:<12} {size:>8} {r['error']}")
+                else:
+                    print(f"{kind:<12} {size:>8} {r['ingest_per_sec']:>9} {r['p50_ms']:>8} {r['p99_ms']:>8} "
+                          f"{r[f'recall_at_{K}']:>7} {r['disk_mb']:>8} {r['rss_mb']:>8}")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for line in regressions:
+            print("REGRESSION", line)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()